@@ -0,0 +1,77 @@
+"""
+Client resource loading, decoding images in the background
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class AssetLoader(object):
+    """Import graphics modules, then decode images on a background thread
+
+    The graphics modules are imported on the thread calling start, which
+    must be the main thread: importing pyglet.gl creates the shadow window
+    and makes its context current on the importing thread. Only decoding
+    and tinting image data runs in the background, while the handshake is
+    in flight. Textures are created on the GL thread the first time a
+    sprite is drawn.
+    """
+    def __init__(self, colors=()):
+        self.colors = colors
+        self.sprite = None
+        self.thread = None
+        self.loaded = False
+        self.__batch = None
+
+    def __import(self):
+        if self.sprite is None:
+            start = time.time()
+            import sprite
+            self.sprite = sprite
+            logger.debug("Assets:Imported graphics in %.3fs",
+                         time.time() - start)
+
+    def __decode(self):
+        start = time.time()
+        self.sprite.ClientBoxman.preload(self.colors)
+        self.loaded = True
+        logger.debug("Assets:Decoded images in %.3fs", time.time() - start)
+
+    def start(self):
+        self.__import()
+        self.thread = threading.Thread(target=self.__decode, name="assets")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self):
+        """Block until loading is done, loading here if never started"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if not self.loaded:
+            self.__import()
+            self.__decode()
+        return self.sprite
+
+    def batch(self):
+        if self.__batch is None:
+            self.wait()
+            import pyglet.graphics
+            self.__batch = pyglet.graphics.Batch()
+        return self.__batch
+
+    def boxman(self, color):
+        return self.wait().ClientBoxman(color, batch=self.batch())
+
+    def draw(self):
+        if self.__batch is not None:
+            self.__batch.draw()
@@ -11,51 +11,48 @@ Game client
 
 import logging
 import math
+import time
 
 import pyglet
 
-from util import ColoredSprite
-from protocol import command, dispatch
+from protocol import bundle, command, dispatch, reliable, session
 from protocol.local import *
+from assets import AssetLoader
+import record
 import sockwrap
 
 logger = logging.getLogger(__name__)
 
-class ClientBoxman(ColoredSprite):
-    """Client Boxman entity"""
-    def __init__(self, color, batch=None, group=None):
-        super(ClientBoxman, self).__init__(
-                pyglet.resource.image('boxman.png'),
-                pyglet.resource.image('boxman-color.png'), color,
-                batch=batch, group=group)
-        self.image.anchor_x = self.width // 2
-        self.image.anchor_y = self.height // 2
-        self.vel_x = 0.0
-        self.vel_y = 0.0
-
-    def set_velocity(self, x, y):
-        self.vel_x = x
-        self.vel_y = y
-
-    def update(self, dt):
-        self.set_position(self.x + self.vel_x * dt, self.y + self.vel_y * dt)
-
 class Client(pyglet.event.EventDispatcher):
     """Handle updating and rendering client entities and socket server"""
-    def __init__(self, batch, sock_server, hellocmd, quitcmd, clientcmd,
-                 sendto, players):
-        self.batch = batch
+    def __init__(self, assets, sock_server, hellocmd, quitcmd, clientcmd,
+                 sendto, players, reliablepack, sessions, bundlepack):
+        self.assets = assets
         self.sock_server = sock_server
         self.hellocmd = hellocmd
         self.quitcmd = quitcmd
         self.clientcmd = clientcmd
         self.sendto = sendto
         self.players = players
+        self.reliablepack = reliablepack
+        self.sessions = sessions
+        self.bundlepack = bundlepack
         self.forward = False
         self.backward = False
         self.rot_cw = False
         self.rot_ccw = False
         self.changed = False
+        self.seen_tick = 0
+        self.sent_tick = 0
+
+    def on_welcome(self, version, capabilities, token, address):
+        version, capabilities = self.sessions.negotiate(address, version,
+                                                        capabilities)
+        logger.debug("Welcome:Version %d:Capabilities 0x%04x",
+                     version, capabilities)
+        if token is not None and capabilities & CAP_COMPACT_HEADER:
+            self.sessions.assign(address, token)
+            self.sessions.confirm(address)
 
     def on_quit(self, address):
         self.dispatch_event('on_client_quit')
@@ -64,10 +61,10 @@ class Client(pyglet.event.EventDispatcher):
         logger.debug("Spawn:Entity %d" % id)
         if type == ENT_PLAYER:
             logger.debug("Spawn:ENT_PLAYER")
-            self.players[id] = ClientBoxman(color, batch=self.batch)
+            self.players[id] = self.assets.boxman(color)
         elif type == ENT_BOXMAN:
             logger.debug("Spawn:ENT_BOXMAN")
-            self.players[id] = ClientBoxman(color, batch=self.batch)
+            self.players[id] = self.assets.boxman(color)
         else:
             logger.warning("Spawn:Unknown type")
 
@@ -78,6 +75,9 @@ class Client(pyglet.event.EventDispatcher):
         else:
             logger.warning("Destroy:Unknown entity %d" % id)
 
+    def on_update_tick(self, tick, address):
+        self.seen_tick = max(self.seen_tick, tick)
+
     def on_update_entity(self, id, pos, direction, velocity, address):
         if id not in self.players:
             return
@@ -86,16 +86,24 @@ class Client(pyglet.event.EventDispatcher):
         self.players[id].set_velocity(*velocity)
 
     def send_hello(self):
-        self.hellocmd.send(self.sendto)
+        self.sessions.offer(self.sendto, CAPABILITIES)
+        self.hellocmd.send(self.sendto, dictionary=self.sessions.dictionary)
 
     def send_quit(self):
         self.quitcmd.send(self.sendto)
 
     def send_client(self):
-        if self.changed:
+        """Send input when it changes or a newer update tick has been seen
+
+        The server rewinds to the latest tick seen for lag compensation, so
+        it is sent every tick even while input is held. It replaces the bare
+        ack that would otherwise go out.
+        """
+        if self.changed or self.seen_tick != self.sent_tick:
             dir = (self.forward, self.backward, self.rot_cw, self.rot_ccw)
-            self.clientcmd.send(dir, self.sendto)
+            self.clientcmd.send(dir, self.sendto, self.seen_tick)
             self.changed = False
+            self.sent_tick = self.seen_tick
 
     def start_move(self, forward=False, backward=False,
                    rot_cw=False, rot_ccw=False):
@@ -115,19 +123,34 @@ class Client(pyglet.event.EventDispatcher):
 
     def update(self, dt):
         self.send_client()
+        self.bundlepack.flush()
+        self.reliablepack.update()
         self.sock_server.update()
         for player in self.players.itervalues():
             player.update(dt)
 
     def draw(self):
-        self.batch.draw()
+        self.assets.draw()
 
 Client.register_event_type('on_client_quit')
 
-def create_client(address, port=11235):
-    """Client creation factory method"""
+def create_client(address, port=11235, recorder=None, dictionary="",
+                  sock=None, assets=None, clock=time.time):
+    """Client creation factory method
+
+    Traffic is written to recorder when given. Bundles are compressed with
+    dictionary when the server has the same one. Graphics are only imported
+    once the returned client's assets are started or first needed. A
+    stand-in socket and assets can be given for clients without a network
+    or display. Timeouts and send pacing follow clock, which gives the time
+    in seconds.
+    """
     players = {}
-    batch = pyglet.graphics.Batch()
+    compressor = bundle.Compressor(dictionary)
+    sessions = session.Sessions(compressor.crc)
+    if assets is None:
+        assets = AssetLoader(BOXMAN_COLORS)
+    welcome_dispatcher = dispatch.WelcomeDispatch()
     quit_dispatcher = dispatch.QuitDispatch()
     spawn_dispatcher = dispatch.SpawnDispatch()
     destroy_dispatcher = dispatch.DestroyDispatch()
@@ -136,23 +159,45 @@ def create_client(address, port=11235):
     cmd_dispatcher.push_handlers(received_quit=quit_dispatcher.dispatch,
                                  received_spawn=spawn_dispatcher.dispatch,
                                  received_destroy=destroy_dispatcher.dispatch,
-                                 received_update=update_dispatcher.dispatch)
-
-    header_dispatcher = dispatch.HeaderDispatch()
-    header_dispatcher.push_handlers(received_header=cmd_dispatcher.dispatch)
-
-    sock_dispatcher = sockwrap.SocketReadDispatch(header_dispatcher)
-    sock_writequeue = sockwrap.SocketWriteQueue()
-    headpack = command.HeaderPack(sock_writequeue)
-    cmdpack = command.CommandPack(headpack)
+                                 received_update=update_dispatcher.dispatch,
+                                 received_welcome=welcome_dispatcher.dispatch)
+    bundle_dispatcher = bundle.BundleDispatch(compressor, sessions)
+    cmd_dispatcher.push_handlers(received_bundle=bundle_dispatcher.dispatch)
+    bundle_dispatcher.push_handlers(received_packet=cmd_dispatcher.dispatch)
+
+    sock_writequeue = sockwrap.SocketWriteQueue(clock=clock)
+    channels = reliable.ReliableChannels(sock_writequeue.congestion, clock)
+    reliable_dispatcher = reliable.ReliableDispatch(channels)
+    reliable_dispatcher.push_handlers(received_packet=cmd_dispatcher.dispatch)
+    header_dispatcher = dispatch.HeaderDispatch(sessions)
+    header_dispatcher.push_handlers(
+            received_header=reliable_dispatcher.dispatch)
+
+    read_dispatcher = header_dispatcher
+    writequeue = sock_writequeue
+    if recorder is not None:
+        read_dispatcher = record.RecordingReadDispatch(header_dispatcher,
+                                                       recorder)
+        writequeue = record.RecordingWriteQueue(sock_writequeue, recorder)
+    sock_dispatcher = sockwrap.SocketReadDispatch(read_dispatcher)
+    headpack = command.HeaderPack(writequeue, sessions)
+    reliablepack = reliable.ReliablePack(headpack, channels)
+    bundlepack = bundle.BundlePack(reliablepack, sessions, compressor)
+    cmdpack = command.CommandPack(bundlepack)
     hellocmd = command.HelloCommand(cmdpack)
     quitcmd = command.QuitCommand(cmdpack)
     clientcmd = command.ClientCommand(cmdpack)
-    sock = sockwrap.create_client_socket()
-    sendto = (address, port)
-    sock_server = sockwrap.SocketServer(sock_dispatcher, sock_writequeue, sock)
-    client = Client(batch, sock_server, hellocmd, quitcmd, clientcmd, sendto,
-                    players)
+    sendto = sockwrap.resolve_address(address, port)
+    if sock is None:
+        sock = sockwrap.create_client_socket()
+        sock_server = sockwrap.SocketServer(sock_dispatcher, sock_writequeue,
+                                            sock)
+    else:
+        sock_server = sockwrap.VirtualSocketServer(sock_dispatcher,
+                                                   sock_writequeue, sock)
+    client = Client(assets, sock_server, hellocmd, quitcmd, clientcmd, sendto,
+                    players, reliablepack, sessions, bundlepack)
+    welcome_dispatcher.push_handlers(client)
     quit_dispatcher.push_handlers(client)
     spawn_dispatcher.push_handlers(client)
     destroy_dispatcher.push_handlers(client)
@@ -0,0 +1,127 @@
+"""
+Server entity storage
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import array
+
+class EntityFields(object):
+    """Entity state as one array per field
+
+    The state of an entity is at the same index in every array.
+    """
+    __slots__ = ('ids', 'x', 'y', 'direction', 'vx', 'vy')
+
+    def __init__(self, fields=None):
+        for name in self.__slots__:
+            if fields is None:
+                values = array.array('H' if name == 'ids' else 'd')
+            else:
+                values = array.array(getattr(fields, name).typecode,
+                                     getattr(fields, name))
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def copy(self):
+        return EntityFields(self)
+
+    def arrays(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+class EntityStore(object):
+    """Dense storage of entities indexed by ID
+
+    Entities are kept packed in a list so iterating them touches no gaps.
+    Removal swaps the last entity into the freed slot. Entities owned by a
+    client are also indexed by the client's address. The state sent to
+    clients is mirrored in fields, packed in the same order, and refreshed
+    by sync once entities have moved.
+    """
+    def __init__(self, idrange):
+        self.entities = []
+        self.owners = []
+        self.slots = [None] * idrange
+        self.addresses = {}
+        self.fields = EntityFields()
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def add(self, entity, address=None):
+        """Add entity, optionally owned by the client at address"""
+        if self.slots[entity.id] is not None:
+            raise KeyError("entity %d already stored" % entity.id)
+        self.slots[entity.id] = len(self.entities)
+        self.entities.append(entity)
+        self.owners.append(address)
+        for values in self.fields.arrays():
+            values.append(0)
+        self.__store(len(self.entities) - 1, entity)
+        if address is not None:
+            self.addresses[address] = entity.id
+
+    def remove(self, id):
+        """Remove and return entity"""
+        slot = self.slots[id]
+        if slot is None:
+            raise KeyError("entity %d not stored" % id)
+        entity = self.entities[slot]
+        address = self.owners[slot]
+        last = self.entities.pop()
+        last_owner = self.owners.pop()
+        for values in self.fields.arrays():
+            last_value = values.pop()
+            if last is not entity:
+                values[slot] = last_value
+        if last is not entity:
+            self.entities[slot] = last
+            self.owners[slot] = last_owner
+            self.slots[last.id] = slot
+        self.slots[id] = None
+        if address is not None:
+            del self.addresses[address]
+        return entity
+
+    def __store(self, slot, entity):
+        fields = self.fields
+        pos = entity.get_position()
+        vel = entity.get_velocity()
+        fields.ids[slot] = entity.id
+        fields.x[slot] = pos[0]
+        fields.y[slot] = pos[1]
+        fields.direction[slot] = entity.get_direction()
+        fields.vx[slot] = vel[0]
+        fields.vy[slot] = vel[1]
+
+    def sync(self):
+        """Copy the state of every entity into fields"""
+        for slot, entity in enumerate(self.entities):
+            self.__store(slot, entity)
+
+    def get(self, id):
+        slot = self.slots[id]
+        if slot is None:
+            raise KeyError("entity %d not stored" % id)
+        return self.entities[slot]
+
+    def by_address(self, address):
+        """Get entity owned by the client at address"""
+        return self.get(self.addresses[address])
+
+    def owner(self, id):
+        """Address of the client owning entity, or None"""
+        slot = self.slots[id]
+        if slot is None:
+            raise KeyError("entity %d not stored" % id)
+        return self.owners[slot]
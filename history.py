@@ -0,0 +1,105 @@
+"""
+Entity state history for lag compensation
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import array
+
+NAN = float('nan')
+
+class StateHistory(object):
+    """Fixed size ring buffer of past entity positions
+
+    Each tick occupies one slot holding the tick number, its time and an
+    array of x, y positions indexed by entity ID, with NaN for entities that
+    didn't exist. Positions wrap around a world of the given size, so
+    interpolation takes the short way across the edges.
+    """
+    def __init__(self, size, idrange, world=(640.0, 480.0)):
+        self.size = size
+        self.idrange = idrange
+        self.world = world
+        self.ticks = array.array('l', [-1] * size)
+        self.times = array.array('d', [0.0] * size)
+        self.empty = array.array('d', [NAN] * (idrange * 2))
+        self.positions = [array.array('d', self.empty) for n in range(size)]
+        self.latest = -1
+
+    def record(self, tick, now, entities):
+        """Store positions of entities at tick"""
+        slot = tick % self.size
+        positions = self.positions[slot]
+        positions[:] = self.empty
+        for entity in entities:
+            pos = entity.get_position()
+            positions[entity.id * 2] = pos[0]
+            positions[entity.id * 2 + 1] = pos[1]
+        self.ticks[slot] = tick
+        self.times[slot] = now
+        self.latest = tick
+
+    def oldest(self):
+        return max(0, self.latest - self.size + 1)
+
+    def __slot(self, tick):
+        if tick < self.oldest() or tick > self.latest:
+            raise KeyError("tick %d not in history" % tick)
+        return tick % self.size
+
+    def time_of(self, tick):
+        return self.times[self.__slot(tick)]
+
+    def position_at_tick(self, id, tick):
+        """Position of entity at tick or None if it didn't exist"""
+        positions = self.positions[self.__slot(tick)]
+        x = positions[id * 2]
+        if x != x:
+            return None
+        return (x, positions[id * 2 + 1])
+
+    def __lerp(self, a, b, fraction, extent):
+        delta = b - a
+        if delta > extent / 2.0:
+            delta -= extent
+        elif delta < -extent / 2.0:
+            delta += extent
+        return (a + delta * fraction) % extent
+
+    def position_at(self, id, when):
+        """Position of entity at time when, interpolated between ticks
+
+        Times outside the history are clamped to the oldest or latest tick.
+        Returns None if the entity didn't exist around that time.
+        """
+        if self.latest < 0:
+            return None
+        oldest = self.oldest()
+        # Binary search the ring in tick order for the first tick after when
+        low, high = oldest, self.latest + 1
+        while low < high:
+            middle = (low + high) // 2
+            if when < self.times[middle % self.size]:
+                high = middle
+            else:
+                low = middle + 1
+        if low <= oldest:
+            return self.position_at_tick(id, oldest)
+        if low > self.latest:
+            return self.position_at_tick(id, self.latest)
+        before = self.position_at_tick(id, low - 1)
+        after = self.position_at_tick(id, low)
+        if before is None or after is None:
+            return before or after
+        start = self.times[(low - 1) % self.size]
+        span = self.times[low % self.size] - start
+        fraction = 0.0
+        if span > 0.0:
+            fraction = (when - start) / span
+        return (self.__lerp(before[0], after[0], fraction, self.world[0]),
+                self.__lerp(before[1], after[1], fraction, self.world[1]))
@@ -0,0 +1,259 @@
+"""
+Protocol command bundling and compression
+
+Commands for the same peer and channel are coalesced into a single bundle
+command until flushed. A bundle is a flags byte followed by the commands,
+each prefixed with its length. The body is deflated when that makes it
+smaller.
+
+Deflate streams are primed with a shared dictionary. Compressing the
+dictionary and keeping a copy of the compressor (and likewise a
+decompressor fed that output) gives the same effect as a preset
+dictionary, which Python 2's zlib can't set directly. Both peers must
+use the same dictionary, checked by CRC in the handshake.
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import collections
+import logging
+import struct
+import threading
+import zlib
+
+import pyglet
+
+from protocol import reliable
+from protocol.local import *
+
+logger = logging.getLogger(__name__)
+
+FLAG_COMPRESSED = 0x01
+LENGTH = struct.Struct("!H")
+# Bundles are kept under a typical path MTU
+MAX_BUNDLE = 1200
+# Room for an update of every entity, the largest single command
+MAX_INFLATED = 8192
+DICTIONARY_SIZE = 32768
+SYNC_TRAILER = "\x00\x00\xff\xff"
+BUNDLE_BYTE = struct.pack("!B", CMD_BUNDLE)
+
+def dictionary_crc(dictionary):
+    """Identify dictionary in the handshake, 0 for no dictionary"""
+    if not dictionary:
+        return 0
+    return zlib.crc32(dictionary) & 0xffffffff or 1
+
+def command_payload(datagram):
+    """Strip header and reliability layer from a recorded datagram"""
+    if ord(datagram[0]) & TOKEN_FLAG:
+        data = datagram[1:]
+    else:
+        data = datagram[len(HEADER_MAGIC):]
+    seq, ack, ack_bits, flags = reliable.unpack_header(data)
+    data = data[reliable.HEADER.size:]
+    if flags & reliable.FLAG_RELIABLE:
+        data = data[reliable.MSGID.size:]
+    return data
+
+def bundle_samples(datagram, compressor):
+    """Commands in a recorded datagram as deflate would see them
+
+    Bundles are split into their commands, inflating compressed ones with
+    compressor, which must have the dictionary the recording was made with.
+    Each command is length prefixed as in a bundle body. Raises zlib.error
+    if a bundle doesn't inflate.
+    """
+    data = command_payload(datagram)
+    if data[:1] != BUNDLE_BYTE:
+        return [LENGTH.pack(len(data)) + data] if data else []
+    flags, = struct.unpack("!B", data[1:2])
+    body = data[2:]
+    if flags & FLAG_COMPRESSED:
+        body = compressor.decompress(body)
+    samples = []
+    offset = 0
+    while offset + LENGTH.size <= len(body):
+        length, = LENGTH.unpack(body[offset:offset+LENGTH.size])
+        samples.append(body[offset:offset+LENGTH.size+length])
+        offset += LENGTH.size + length
+    return samples
+
+def build_dictionary(samples, size=DICTIONARY_SIZE, chunk=8):
+    """Build a deflate dictionary from sample payloads
+
+    Picks the chunks that recur most often across samples. Deflate reaches
+    recent bytes most cheaply, so the most common chunks go last.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        for index in xrange(0, len(sample) - chunk + 1, chunk // 2):
+            counts[sample[index:index+chunk]] += 1
+    common = [data for data, count in counts.most_common(size // chunk)
+              if count > 1]
+    return "".join(reversed(common))[-size:]
+
+class Compressor(object):
+    """Raw deflate primed with a dictionary"""
+    def __init__(self, dictionary=""):
+        self.dictionary = dictionary
+        self.crc = dictionary_crc(dictionary)
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        primed = self.compressor.compress(dictionary) + \
+                 self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.decompressor = zlib.decompressobj(-15)
+        self.decompressor.decompress(primed)
+
+    def compress(self, data):
+        compressor = self.compressor.copy()
+        data = compressor.compress(data) + \
+               compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[:-len(SYNC_TRAILER)]
+
+    def decompress(self, data, limit=MAX_INFLATED):
+        """Inflate data, raising zlib.error past limit bytes"""
+        decompressor = self.decompressor.copy()
+        data = decompressor.decompress(data + SYNC_TRAILER, limit)
+        if decompressor.unconsumed_tail:
+            raise zlib.error("inflates past %d bytes" % limit)
+        return data
+
+class BundlePack(object):
+    """Bundling and compression packet packer
+
+    Only peers that negotiated CAP_BUNDLE get bundles, and only those that
+    negotiated CAP_COMPRESSION get them compressed. Without buffering each
+    command is sent straight away, still compressed where it helps.
+    """
+    def __init__(self, packer, sessions, compressor, buffering=True):
+        self.packer = packer
+        self.sessions = sessions
+        self.compressor = compressor
+        self.buffering = buffering
+        self.pending = {}
+        self.lock = threading.Lock()
+        # Statistics
+        self.commands = 0
+        self.packets = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.compressed = 0
+
+    def pack(self, data, sendto, reliable=False, droppable=False):
+        with self.lock:
+            self.commands += 1
+            self.raw_bytes += len(data)
+        if not self.sessions.has(sendto, CAP_BUNDLE):
+            self.__send(data, sendto, reliable, droppable)
+            return
+        if not self.buffering:
+            self.__send_bundle([data], sendto, reliable, droppable)
+            return
+        with self.lock:
+            # Only bundles of droppable commands may be superseded
+            key = (sendto, reliable, droppable)
+            bundle = self.pending.setdefault(key, [[], 0])
+            size = LENGTH.size + len(data)
+            if bundle[0] and bundle[1] + size > MAX_BUNDLE:
+                del self.pending[key]
+                flush = bundle[0]
+                bundle = self.pending[key] = [[], 0]
+            else:
+                flush = None
+            bundle[0].append(data)
+            bundle[1] += size
+        if flush is not None:
+            self.__send_bundle(flush, sendto, reliable, droppable)
+
+    def flush(self, address=None):
+        """Send everything bundled so far, or only what is for address"""
+        with self.lock:
+            if address is None:
+                pending, self.pending = self.pending, {}
+            else:
+                pending = dict((key, self.pending.pop(key))
+                               for key in self.pending.keys()
+                               if key[0] == address)
+        for (sendto, reliable, droppable), (commands, size) in \
+                pending.iteritems():
+            self.__send_bundle(commands, sendto, reliable, droppable)
+
+    def __send(self, data, sendto, reliable, droppable):
+        with self.lock:
+            self.packets += 1
+            self.sent_bytes += len(data)
+        self.packer.pack(data, sendto, reliable=reliable, droppable=droppable)
+
+    def __send_bundle(self, commands, sendto, reliable, droppable):
+        compress = self.sessions.has(sendto, CAP_COMPRESSION)
+        if len(commands) == 1 and not compress:
+            self.__send(commands[0], sendto, reliable, droppable)
+            return
+        body = "".join(LENGTH.pack(len(data)) + data for data in commands)
+        flags = 0
+        if compress:
+            deflated = self.compressor.compress(body)
+            if len(deflated) < len(body):
+                body = deflated
+                flags |= FLAG_COMPRESSED
+                with self.lock:
+                    self.compressed += 1
+        if len(commands) == 1 and not flags & FLAG_COMPRESSED:
+            # Compression didn't pay, so the bundle would only add bytes
+            self.__send(commands[0], sendto, reliable, droppable)
+            return
+        self.__send(struct.pack("!BB", CMD_BUNDLE, flags) + body, sendto,
+                    reliable, droppable)
+
+class BundleDispatch(pyglet.event.EventDispatcher):
+    """Dispatch packet unwrapping bundle command
+
+    Bundles are only taken from peers allowed CAP_BUNDLE, and compressed
+    ones from peers allowed CAP_COMPRESSION. A bundle holding another
+    bundle is dropped whole.
+    """
+    def __init__(self, compressor, sessions):
+        super(BundleDispatch, self).__init__()
+        self.compressor = compressor
+        self.sessions = sessions
+        self.rejected = 0
+
+    def __reject(self, reason, address):
+        logger.debug("Bundle:%s from %s", reason, repr(address))
+        self.rejected += 1
+
+    def dispatch(self, data, address):
+        if not self.sessions.accepts(address, CAP_BUNDLE) or not data:
+            self.__reject("Unexpected bundle", address)
+            return
+        flags, = struct.unpack("!B", data[:1])
+        body = data[1:]
+        if flags & FLAG_COMPRESSED:
+            if not self.sessions.accepts(address, CAP_COMPRESSION):
+                self.__reject("Unexpected compressed bundle", address)
+                return
+            try:
+                body = self.compressor.decompress(body)
+            except zlib.error as e:
+                self.__reject("Bad compressed data (%s)" % e, address)
+                return
+        commands = []
+        offset = 0
+        while offset + LENGTH.size <= len(body):
+            length, = LENGTH.unpack(body[offset:offset+LENGTH.size])
+            offset += LENGTH.size
+            command = body[offset:offset+length]
+            offset += length
+            if command[:1] == BUNDLE_BYTE:
+                self.__reject("Nested bundle", address)
+                return
+            commands.append(command)
+        for command in commands:
+            self.dispatch_event('received_packet', command, address)
+
+BundleDispatch.register_event_type('received_packet')
@@ -13,14 +13,27 @@ import struct
 
 from protocol.local import *
 
+ENTITY_UPDATE = struct.Struct("!Bfffff")
+
 class HeaderPack(object):
-    """Top level packet packer"""
-    def __init__(self, queue):
-        self.queue = queue
+    """Top level packet packer
 
-    def pack(self, data, sendto):
-        data = struct.pack("!6s", "BOXMAN") + data
-        self.queue.push(data, sendto)
+    Once a session token is confirmed with a peer the header shrinks to
+    the single token byte.
+    """
+    def __init__(self, queue, sessions=None):
+        self.queue = queue
+        self.sessions = sessions
+
+    def pack(self, data, sendto, droppable=False, stamp=None):
+        token = None
+        if self.sessions is not None:
+            token = self.sessions.token(sendto)
+        if token is None:
+            data = struct.pack("!6s", HEADER_MAGIC) + data
+        else:
+            data = struct.pack("!B", TOKEN_FLAG | token) + data
+        self.queue.push(data, sendto, droppable, stamp)
 
 class CommandPack(object):
     """Command packet packer"""
@@ -29,15 +42,33 @@ class CommandPack(object):
 
     def pack(self, cmd, data, sendto):
         data = struct.pack("!B", cmd) + data
-        self.packer.pack(data, sendto)
+        self.packer.pack(data, sendto, reliable=cmd in RELIABLE_COMMANDS,
+                         droppable=cmd in DROPPABLE_COMMANDS)
 
 class HelloCommand(object):
     """Client announce command"""
     def __init__(self, packer):
         self.packer = packer
 
-    def send(self, sendto):
-        self.packer.pack(CMD_HELLO, "", sendto)
+    def send(self, sendto, version=PROTOCOL_VERSION,
+             capabilities=CAPABILITIES, dictionary=0):
+        data = struct.pack("!BHI", version, capabilities, dictionary)
+        self.packer.pack(CMD_HELLO, data, sendto)
+
+class WelcomeCommand(object):
+    """Server handshake reply command
+
+    Carries the negotiated version and capabilities, and the session token
+    or 0xff for none.
+    """
+    def __init__(self, packer):
+        self.packer = packer
+
+    def send(self, version, capabilities, token, sendto):
+        if token is None:
+            token = 0xff
+        self.packer.pack(CMD_WELCOME,
+                struct.pack("!BHB", version, capabilities, token), sendto)
 
 class QuitCommand(object):
     """Client quit command"""
@@ -66,19 +97,32 @@ class DestroyCommand(object):
         self.packer.pack(CMD_DESTROY, struct.pack("!B", entityid), sendto)
 
 class UpdateCommand(object):
-    """Update entity command"""
+    """Update entity command
+
+    Entity state comes from an entity.EntityFields and is packed with one
+    struct call over all of its arrays.
+    """
     def __init__(self, packer):
         self.packer = packer
-
-    def send(self, entities, sendto):
-        if len(entities) < 1:
+        self.structs = {}
+
+    def __struct(self, count):
+        try:
+            return self.structs[count]
+        except KeyError:
+            updates = struct.Struct("!" + ENTITY_UPDATE.format[1:] * count)
+            return self.structs.setdefault(count, updates)
+
+    def send(self, fields, sendto, tick=0):
+        count = len(fields)
+        if count < 1:
             return
-        data = struct.pack("!I", len(entities))
-        for entity in entities:
-            pos = entity.get_position()
-            vel = entity.get_velocity()
-            data += struct.pack("!Bfffff", entity.id, pos[0], pos[1],
-                                entity.get_direction(), vel[0], vel[1])
+        arrays = fields.arrays()
+        values = [None] * (count * len(arrays))
+        for offset, field in enumerate(arrays):
+            values[offset::len(arrays)] = field
+        data = struct.pack("!II", tick, count) + \
+               self.__struct(count).pack(*values)
         self.packer.pack(CMD_UPDATE, data, sendto)
 
 class ClientCommand(object):
@@ -86,5 +130,10 @@ class ClientCommand(object):
     def __init__(self, packer):
         self.packer = packer
 
-    def send(self, direction, sendto):
-        self.packer.pack(CMD_CLIENT, struct.pack("!????", *direction), sendto)
+    def send(self, direction, sendto, tick=0):
+        """Send client state stamped with the latest update tick seen"""
+        forward, backward, rot_cw, rot_ccw = direction
+        self.packer.pack(CMD_CLIENT,
+                struct.pack("!????I", forward, backward, rot_cw, rot_ccw,
+                            tick),
+                sendto)
@@ -16,24 +16,46 @@ import pyglet
 from protocol.local import *
 
 class HeaderDispatch(pyglet.event.EventDispatcher):
-    """Dispatch packet unwrapping header"""
-    def __init__(self):
+    """Dispatch packet unwrapping header
+
+    Compact headers are accepted from peers holding a matching session
+    token, and confirm the peer has it so compact headers are sent back.
+    """
+    def __init__(self, sessions=None):
         super(HeaderDispatch, self).__init__()
+        self.sessions = sessions
 
     def dispatch(self, data, address):
-        ident, = struct.unpack("!6s", data[:6])
-        if ident != "BOXMAN":
+        if not data:
+            return
+        first = ord(data[0])
+        if first & TOKEN_FLAG:
+            token = first & (TOKEN_FLAG - 1)
+            if self.sessions is None or \
+                    not self.sessions.valid(address, token):
+                return
+            self.sessions.confirm(address)
+            self.dispatch_event('received_header', data[1:], address)
             return
-        self.dispatch_event('received_header', data[6:], address)
+        if data[:len(HEADER_MAGIC)] != HEADER_MAGIC:
+            return
+        self.dispatch_event('received_header', data[len(HEADER_MAGIC):],
+                            address)
 
 HeaderDispatch.register_event_type('received_header')
 
 class CommandDispatch(pyglet.event.EventDispatcher):
-    """Dispatch packet unwrapping command type"""
+    """Dispatch packet unwrapping command type
+
+    Like the command dispatchers below it drops packets too short to hold
+    their command rather than raising.
+    """
     def __init__(self):
         super(CommandDispatch, self).__init__()
 
     def dispatch(self, data, address):
+        if not data:
+            return
         cmd, = struct.unpack("!B", data[:1])
         if cmd == CMD_HELLO:
             self.dispatch_event('received_hello', data[1:], address)
@@ -47,6 +69,10 @@ class CommandDispatch(pyglet.event.EventDispatcher):
             self.dispatch_event('received_update', data[1:], address)
         elif cmd == CMD_CLIENT:
             self.dispatch_event('received_client', data[1:], address)
+        elif cmd == CMD_WELCOME:
+            self.dispatch_event('received_welcome', data[1:], address)
+        elif cmd == CMD_BUNDLE:
+            self.dispatch_event('received_bundle', data[1:], address)
 
 CommandDispatch.register_event_type('received_hello')
 CommandDispatch.register_event_type('received_quit')
@@ -54,6 +80,8 @@ CommandDispatch.register_event_type('received_spawn')
 CommandDispatch.register_event_type('received_destroy')
 CommandDispatch.register_event_type('received_update')
 CommandDispatch.register_event_type('received_client')
+CommandDispatch.register_event_type('received_welcome')
+CommandDispatch.register_event_type('received_bundle')
 
 class HelloDispatch(pyglet.event.EventDispatcher):
     """Dispatch packet unwrapping hello command"""
@@ -61,10 +89,33 @@ class HelloDispatch(pyglet.event.EventDispatcher):
         super(HelloDispatch, self).__init__()
 
     def dispatch(self, data, address):
-        self.dispatch_event('on_hello', address)
+        # Hello from before version negotiation has no payload
+        version, capabilities, dictionary = 0, 0, 0
+        if len(data) >= 7:
+            version, capabilities, dictionary = struct.unpack("!BHI", data[:7])
+        elif len(data) >= 3:
+            version, capabilities = struct.unpack("!BH", data[:3])
+        self.dispatch_event('on_hello', version, capabilities, dictionary,
+                            address)
 
 HelloDispatch.register_event_type('on_hello')
 
+class WelcomeDispatch(pyglet.event.EventDispatcher):
+    """Dispatch packet unwrapping welcome command"""
+    def __init__(self):
+        super(WelcomeDispatch, self).__init__()
+
+    def dispatch(self, data, address):
+        if len(data) < 4:
+            return
+        version, capabilities, token = struct.unpack("!BHB", data[:4])
+        if token == 0xff:
+            token = None
+        self.dispatch_event('on_welcome', version, capabilities, token,
+                            address)
+
+WelcomeDispatch.register_event_type('on_welcome')
+
 class QuitDispatch(pyglet.event.EventDispatcher):
     """Dispatch packet unwrapping quit command"""
     def __init__(self):
@@ -81,6 +132,8 @@ class SpawnDispatch(pyglet.event.EventDispatcher):
         super(SpawnDispatch, self).__init__()
 
     def dispatch(self, data, address):
+        if len(data) < 5:
+            return
         type, id, color_r, color_g, color_b = struct.unpack("!BBBBB", data[:5])
         color = (color_r, color_g, color_b)
         self.dispatch_event('on_spawn_entity', type, id, color, address)
@@ -93,6 +146,8 @@ class DestroyDispatch(pyglet.event.EventDispatcher):
         super(DestroyDispatch, self).__init__()
 
     def dispatch(self, data, address):
+        if len(data) < 1:
+            return
         id, = struct.unpack("!B", data[:1])
         self.dispatch_event('on_destroy_entity', id, address)
 
@@ -112,21 +167,52 @@ class UpdateDispatch(pyglet.event.EventDispatcher):
                             address)
 
     def dispatch(self, data, address):
-        count, = struct.unpack("!I", data[:4])
+        if len(data) < 8:
+            return
+        tick, count = struct.unpack("!II", data[:8])
+        if len(data) < 8 + 21 * count:
+            return
+        self.dispatch_event('on_update_tick', tick, address)
         for n in range(count):
-            self.single(data[4+21*n:], address)
+            self.single(data[8+21*n:], address)
 
+UpdateDispatch.register_event_type('on_update_tick')
 UpdateDispatch.register_event_type('on_update_entity')
 
 class ClientDispatch(pyglet.event.EventDispatcher):
-    """Dispatch packet unwrapping client state command"""
+    """Dispatch packet unwrapping client state command
+
+    Client states are coalesced per address and dispatched once per flush
+    with the latest state, every control held since the last flush, so
+    presses released within a tick aren't lost, and the latest update tick
+    the client had seen. How many states an address can send per flush is
+    bounded where packets are read.
+    """
     def __init__(self, players):
         super(ClientDispatch, self).__init__()
         self.players = players
+        self.pending = {}
 
     def dispatch(self, data, address):
-        forward, backward, rot_cw, rot_ccw = struct.unpack("!????", data[:4])
-        self.dispatch_event('on_client', (forward, backward, rot_cw, rot_ccw),
-                            address)
+        if address not in self.players or len(data) < 8:
+            return
+        forward, backward, rot_cw, rot_ccw, tick = \
+                struct.unpack("!????I", data[:8])
+        movement = (forward, backward, rot_cw, rot_ccw)
+        try:
+            pending = self.pending[address]
+        except KeyError:
+            pending = self.pending[address] = [movement, movement, tick]
+            return
+        pending[0] = movement
+        pending[1] = tuple(held or now for held, now in
+                           zip(pending[1], movement))
+        pending[2] = max(pending[2], tick)
+
+    def flush(self):
+        """Dispatch client states coalesced since the last flush"""
+        pending, self.pending = self.pending, {}
+        for address, (movement, held, tick) in pending.iteritems():
+            self.dispatch_event('on_client', movement, held, tick, address)
 
 ClientDispatch.register_event_type('on_client')
@@ -16,9 +16,51 @@ Protocol local definitions
     CMD_DESTROY,
     CMD_UPDATE,
     CMD_CLIENT,
-) = range(6)
+    CMD_WELCOME,
+    CMD_BUNDLE,
+) = range(8)
+
+# Commands sent over the reliable ordered channel
+RELIABLE_COMMANDS = (
+    CMD_HELLO,
+    CMD_WELCOME,
+    CMD_QUIT,
+    CMD_SPAWN,
+    CMD_DESTROY,
+)
+
+# Commands superseded by newer ones of the same kind when queued
+DROPPABLE_COMMANDS = (
+    CMD_UPDATE,
+)
+
+PROTOCOL_VERSION = 1
+
+# Capability bits negotiated in the handshake
+CAP_COMPACT_HEADER = 0x0001
+CAP_BUNDLE = 0x0002
+# Only granted when both peers use the same compression dictionary
+CAP_COMPRESSION = 0x0004
+
+# Capabilities this implementation supports
+CAPABILITIES = CAP_COMPACT_HEADER | CAP_BUNDLE | CAP_COMPRESSION
+
+HEADER_MAGIC = "BOXMAN"
+# Compact headers are a single byte with the high bit set, which can't
+# start the magic, holding the session token
+TOKEN_FLAG = 0x80
+MAX_TOKENS = 0x80
 
 (
     ENT_PLAYER,
     ENT_BOXMAN,
 ) = range(2)
+
+BOXMAN_COLORS = (
+    (0, 0, 255),
+    (0, 255, 0),
+    (0, 255, 255),
+    (255, 0, 0),
+    (255, 0, 255),
+    (255, 255, 0),
+)
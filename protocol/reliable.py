@@ -0,0 +1,341 @@
+"""
+Protocol reliability layer
+
+Every packet carries a 15-bit sequence number along with the most recent
+sequence number received from the peer and a bitfield acknowledging the 16
+before it, six bytes in all. The top bit of the sequence number field marks
+reliable messages, which also carry a message ID, are retransmitted until a
+packet carrying them is acknowledged and are delivered in order. Unreliable
+messages are never retransmitted and stale ones are dropped.
+
+A reliable message is never given up on while the peer may still be there,
+since the receiver can't deliver anything after a missing message. Only
+once the peer is forgotten are its outstanding messages abandoned; a peer
+that goes silent is left for eviction to deal with.
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import functools
+import logging
+import struct
+import threading
+import time
+
+import pyglet
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct("!HHH")
+MSGID = struct.Struct("!H")
+# Flag in the top bit of the sequence number field
+FLAG_RELIABLE = 0x8000
+ACK_BITS = 16
+SEQ_MOD = 0x8000
+MSGID_MOD = 0x10000
+
+def seq_greater(a, b, mod=SEQ_MOD):
+    """Compare sequence numbers allowing for wrap around"""
+    return ((a > b) and (a - b <= mod // 2)) or \
+           ((a < b) and (b - a > mod // 2))
+
+def seq_distance(a, b, mod=SEQ_MOD):
+    """Number of steps sequence number b is behind a"""
+    return (a - b) % mod
+
+def pack_header(seq, ack, ack_bits, flags=0):
+    return HEADER.pack(seq | flags, ack, ack_bits)
+
+def unpack_header(data):
+    """Sequence number, ack, ack bits and flags from the start of data"""
+    seq, ack, ack_bits = HEADER.unpack(data[:HEADER.size])
+    return seq & (SEQ_MOD - 1), ack, ack_bits, seq & FLAG_RELIABLE
+
+class ReliableChannel(object):
+    """Reliability state for a single peer"""
+    def __init__(self, now):
+        # Sending
+        self.seq = 0
+        self.msgid = 0
+        self.pending = {}
+        self.sent = {}
+        self.queued = 0
+        self.rtt = None
+        # Receiving
+        self.remote_seq = None
+        self.ack_bits = 0
+        self.recv_msgid = 1
+        self.received = {}
+        self.ack_pending = False
+        self.last_received = now
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) % SEQ_MOD
+        return self.seq
+
+    def next_msgid(self):
+        self.msgid = (self.msgid + 1) % MSGID_MOD
+        if self.msgid == 0:
+            self.msgid = 1
+        return self.msgid
+
+    def remote_ack(self):
+        if self.remote_seq is None:
+            return 0
+        return self.remote_seq
+
+    def receive_seq(self, seq, now, ack=True):
+        """Record packet sequence number as received
+
+        Only packets with ack set need acknowledging by a bare ack if nothing
+        else is sent. Returns False for duplicates and packets older than
+        the latest.
+        """
+        if ack:
+            self.ack_pending = True
+        self.last_received = now
+        if self.remote_seq is None:
+            self.remote_seq = seq
+            return True
+        if seq_greater(seq, self.remote_seq):
+            shift = seq_distance(seq, self.remote_seq)
+            if shift > ACK_BITS:
+                self.ack_bits = 0
+            else:
+                self.ack_bits = ((self.ack_bits << 1 | 1) << (shift - 1)) & \
+                                ((1 << ACK_BITS) - 1)
+            self.remote_seq = seq
+            return True
+        distance = seq_distance(self.remote_seq, seq)
+        if 0 < distance <= ACK_BITS:
+            self.ack_bits |= 1 << (distance - 1)
+        return False
+
+class ReliableChannels(object):
+    """Reliability state for all peers shared by packer and dispatcher
+
+    congestion is an optional callable giving a send rate estimate for an
+    address, which is fed round trip times and losses. Timeouts and round
+    trip times are measured by clock, which gives the time in seconds.
+    """
+    def __init__(self, congestion=None, clock=time.time):
+        self.congestion = congestion
+        self.clock = clock
+        self.channels = {}
+        self.forgotten = set()
+        self.lock = threading.Lock()
+        self.resent = 0
+        self.lost = 0
+        self.abandoned = 0
+
+    def __contains__(self, address):
+        return address in self.channels
+
+    def get(self, address):
+        try:
+            return self.channels[address]
+        except KeyError:
+            channel = self.channels[address] = ReliableChannel(self.clock())
+            return channel
+
+    def forget(self, address):
+        """Discard state for address once reliable messages are done"""
+        self.forgotten.add(address)
+        self.collect(address)
+
+    def expire(self, now, timeout):
+        """Discard state for addresses not heard from within timeout"""
+        with self.lock:
+            for address, channel in self.channels.items():
+                if now - channel.last_received > timeout:
+                    self.forgotten.discard(address)
+                    del self.channels[address]
+
+    def collect(self, address):
+        channel = self.channels.get(address)
+        if address in self.forgotten and \
+                (channel is None or not channel.pending):
+            self.forgotten.discard(address)
+            self.channels.pop(address, None)
+
+    def on_ack(self, address, channel, ack, ack_bits, now):
+        """Process acknowledgements received from address"""
+        acked = [ack]
+        for bit in range(ACK_BITS):
+            if ack_bits & (1 << bit):
+                acked.append((ack - bit - 1) % SEQ_MOD)
+        for seq in acked:
+            try:
+                sent_time, msgid = channel.sent.pop(seq)
+            except KeyError:
+                continue
+            rtt = now - sent_time
+            if channel.rtt is None:
+                channel.rtt = rtt
+            else:
+                channel.rtt = 0.875 * channel.rtt + 0.125 * rtt
+            if self.congestion is not None:
+                self.congestion(address).on_ack(rtt)
+            if msgid is not None:
+                channel.pending.pop(msgid, None)
+        # Anything falling out of the ack window was lost
+        for seq in channel.sent.keys():
+            if seq_distance(ack, seq) >= ACK_BITS and \
+                    seq_greater(ack, seq):
+                sent_time, msgid = channel.sent.pop(seq)
+                self.lost += 1
+                if self.congestion is not None:
+                    self.congestion(address).on_loss(sent_time, now)
+        self.collect(address)
+
+class ReliablePack(object):
+    """Reliability layer packet packer
+
+    Retransmits back off exponentially up to MAX_RTO so an outage doesn't
+    flood the link once it heals. The header is only filled in when the
+    write queue stamps the packet as it is written, so sequence numbers
+    follow send order without gaps for packets superseded in the queue, and
+    round trips are timed from when a packet reaches the wire.
+    """
+    MIN_RTO = 0.1
+    INITIAL_RTO = 0.25
+    MAX_RTO = 2.0
+    # Resends before messages to a forgotten peer are abandoned
+    MAX_RESENDS = 10
+
+    def __init__(self, packer, channels):
+        self.packer = packer
+        self.channels = channels
+
+    def rto(self, channel, resends=0):
+        if channel.rtt is None:
+            rto = self.INITIAL_RTO
+        else:
+            rto = max(self.MIN_RTO, 2.0 * channel.rtt)
+        return min(self.MAX_RTO, rto * 2 ** min(resends, 8))
+
+    def __send(self, channel, data, sendto, msgid, droppable=False):
+        if msgid is not None:
+            data = MSGID.pack(msgid) + data
+        with self.channels.lock:
+            channel.queued += 1
+        self.packer.pack("\x00" * HEADER.size + data, sendto,
+                         droppable=droppable,
+                         stamp=functools.partial(self.__stamp, channel,
+                                                 msgid, len(data)))
+
+    def __stamp(self, channel, msgid, size, packet):
+        """Fill in the header of a packet being written"""
+        with self.channels.lock:
+            channel.queued -= 1
+            if packet is None:
+                return None
+            now = self.channels.clock()
+            seq = channel.next_seq()
+            # Bare acks aren't acknowledged in turn, so aren't tracked
+            if size or msgid is not None:
+                channel.sent[seq] = (now, msgid)
+            channel.ack_pending = False
+            if msgid is None:
+                header = pack_header(seq, channel.remote_ack(),
+                                     channel.ack_bits)
+            else:
+                header = pack_header(seq, channel.remote_ack(),
+                                     channel.ack_bits, FLAG_RELIABLE)
+                message = channel.pending.get(msgid)
+                if message is not None:
+                    message[1] = now
+        start = len(packet) - size - HEADER.size
+        return packet[:start] + header + packet[start+HEADER.size:]
+
+    def pack(self, data, sendto, reliable=False, droppable=False):
+        """Send data, retransmitting it until acknowledged if reliable
+
+        Unreliable droppable data may be superseded by newer droppable data
+        while queued. Retransmits and bare acks are never droppable.
+        """
+        now = self.channels.clock()
+        with self.channels.lock:
+            channel = self.channels.get(sendto)
+            msgid = None
+            if reliable:
+                msgid = channel.next_msgid()
+                channel.pending[msgid] = [data, now, 0]
+        self.__send(channel, data, sendto, msgid,
+                    droppable and msgid is None)
+
+    def update(self):
+        """Retransmit unacknowledged reliable messages and send bare acks"""
+        now = self.channels.clock()
+        for sendto, channel in self.channels.channels.items():
+            forgotten = sendto in self.channels.forgotten
+            for msgid, message in sorted(channel.pending.items()):
+                data, sent_time, resends = message
+                if now - sent_time < self.rto(channel, resends):
+                    continue
+                if forgotten and resends >= self.MAX_RESENDS:
+                    logger.debug("Reliable:Gave up on message %d to %s",
+                                 msgid, repr(sendto))
+                    del channel.pending[msgid]
+                    self.channels.abandoned += 1
+                    continue
+                message[1] = now
+                message[2] = resends + 1
+                self.channels.resent += 1
+                self.__send(channel, data, sendto, msgid)
+            # Anything still queued will carry the ack when it is written
+            if channel.ack_pending and not channel.queued:
+                self.__send(channel, "", sendto, None)
+            self.channels.collect(sendto)
+
+class ReliableDispatch(pyglet.event.EventDispatcher):
+    """Dispatch packet unwrapping reliability layer"""
+    MAX_BUFFERED = 256
+
+    def __init__(self, channels):
+        super(ReliableDispatch, self).__init__()
+        self.channels = channels
+
+    def dispatch(self, data, address):
+        if len(data) < HEADER.size:
+            return
+        seq, ack, ack_bits, flags = unpack_header(data)
+        if flags & FLAG_RELIABLE and len(data) < HEADER.size + MSGID.size:
+            return
+        data = data[HEADER.size:]
+        now = self.channels.clock()
+        with self.channels.lock:
+            channel = self.channels.get(address)
+            latest = channel.receive_seq(seq, now,
+                                         data or flags & FLAG_RELIABLE)
+            self.channels.on_ack(address, channel, ack, ack_bits, now)
+        if not flags & FLAG_RELIABLE:
+            if latest and data:
+                self.dispatch_event('received_packet', data, address)
+            return
+        msgid, = MSGID.unpack(data[:MSGID.size])
+        data = data[MSGID.size:]
+        if msgid == channel.recv_msgid:
+            self.dispatch_event('received_packet', data, address)
+            self.__advance(channel, address)
+        elif seq_greater(msgid, channel.recv_msgid, MSGID_MOD) and \
+                len(channel.received) < self.MAX_BUFFERED:
+            channel.received[msgid] = data
+        # Otherwise a duplicate of something already delivered
+
+    def __advance(self, channel, address):
+        """Deliver buffered reliable messages that are now in order"""
+        while True:
+            channel.recv_msgid = (channel.recv_msgid + 1) % MSGID_MOD or 1
+            try:
+                data = channel.received.pop(channel.recv_msgid)
+            except KeyError:
+                return
+            self.dispatch_event('received_packet', data, address)
+
+ReliableDispatch.register_event_type('received_packet')
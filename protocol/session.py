@@ -0,0 +1,82 @@
+"""
+Protocol session state
+
+Tracks what was negotiated with each peer in the hello/welcome handshake:
+the protocol version, the capabilities both sides share and the session
+token that replaces the full header once both sides know it.
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+from protocol.local import *
+
+class Sessions(object):
+    """Negotiated session state for all peers"""
+    def __init__(self, dictionary=0):
+        self.dictionary = dictionary
+        self.versions = {}
+        self.capabilities = {}
+        self.offered = {}
+        self.tokens = {}
+        self.confirmed = set()
+
+    def offer(self, address, capabilities):
+        """Note capabilities offered to address ahead of its reply"""
+        self.offered[address] = capabilities
+
+    def negotiate(self, address, version, capabilities, dictionary=None):
+        """Settle on the version and capabilities shared with address
+
+        Compression is dropped unless dictionary, the CRC of the peer's
+        compression dictionary, matches ours.
+        """
+        version = min(version, PROTOCOL_VERSION)
+        capabilities &= CAPABILITIES
+        if dictionary is not None and dictionary != self.dictionary:
+            capabilities &= ~CAP_COMPRESSION
+        self.versions[address] = version
+        self.capabilities[address] = capabilities
+        return version, capabilities
+
+    def has(self, address, capability):
+        return bool(self.capabilities.get(address, 0) & capability)
+
+    def accepts(self, address, capability):
+        """Whether address may use capability with us
+
+        Before the handshake completes a peer may already use what we
+        offered it, since its reply can arrive along with other commands.
+        """
+        if address in self.capabilities:
+            return self.has(address, capability)
+        return bool(self.offered.get(address, 0) & capability)
+
+    def assign(self, address, token):
+        """Give address a session token for compact headers"""
+        self.tokens[address] = token
+
+    def confirm(self, address):
+        """Start sending compact headers to address"""
+        if address in self.tokens:
+            self.confirmed.add(address)
+
+    def token(self, address):
+        """Token to send compact headers to address with, or None"""
+        if address in self.confirmed:
+            return self.tokens[address]
+        return None
+
+    def valid(self, address, token):
+        return self.tokens.get(address) == token
+
+    def forget(self, address):
+        self.versions.pop(address, None)
+        self.capabilities.pop(address, None)
+        self.offered.pop(address, None)
+        self.confirmed.discard(address)
+        return self.tokens.pop(address, None)
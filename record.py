@@ -0,0 +1,183 @@
+"""
+Packet stream recording and replay
+
+A recording is a file header followed by append-only records. Each record
+is a fixed size header giving the data length, a timestamp, the direction
+and the peer address, followed by the datagram itself. Recordings are read
+through mmap with an index of record offsets built from the headers alone.
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import array
+import bisect
+import functools
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = "BOXREC\x01"
+RECORD = struct.Struct("!Id?4sH")
+
+(
+    REC_IN,
+    REC_OUT,
+) = (False, True)
+
+class RecordFormatError(Exception):
+    """Error raised when a file is not a packet recording"""
+    pass
+
+class Recorder(object):
+    """Append timestamped datagrams to a recording"""
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.records = 0
+
+    def record(self, direction, data, address, now=None):
+        if now is None:
+            now = time.time()
+        host, port = address
+        header = RECORD.pack(len(data), now, direction,
+                             socket.inet_aton(host), port)
+        with self.lock:
+            self.file.write(header + data)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class RecordingReadDispatch(object):
+    """Record received datagrams before dispatching them"""
+    def __init__(self, dispatcher, recorder):
+        self.dispatcher = dispatcher
+        self.recorder = recorder
+
+    def dispatch(self, data, address):
+        self.recorder.record(REC_IN, data, address)
+        self.dispatcher.dispatch(data, address)
+
+class RecordingWriteQueue(object):
+    """Record datagrams as a write queue writes them
+
+    Datagrams the queue supersedes or drops are never recorded.
+    """
+    def __init__(self, queue, recorder):
+        self.queue = queue
+        self.recorder = recorder
+
+    def push(self, data, address, droppable=False, stamp=None):
+        self.queue.push(data, address, droppable,
+                        functools.partial(self.__record, address, stamp))
+
+    def __record(self, address, stamp, data):
+        if stamp is not None:
+            data = stamp(data)
+        if data is not None:
+            self.recorder.record(REC_OUT, data, address)
+        return data
+
+class RecordReader(object):
+    """Random access to a recording through mmap"""
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size < len(MAGIC):
+            raise RecordFormatError("%s: too short" % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise RecordFormatError("%s: bad magic" % path)
+        self.offsets = array.array('L')
+        self.times = array.array('d')
+        self.__index()
+
+    def __index(self):
+        offset = len(MAGIC)
+        end = len(self.map)
+        while offset + RECORD.size <= end:
+            length, now, direction, host, port = \
+                    RECORD.unpack_from(self.map, offset)
+            if offset + RECORD.size + length > end:
+                logger.warning("Recording:Truncated record at %d", offset)
+                break
+            self.offsets.append(offset)
+            self.times.append(now)
+            offset += RECORD.size + length
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        """Get (timestamp, direction, data, address) of record"""
+        offset = self.offsets[index]
+        length, now, direction, host, port = \
+                RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        return (now, direction, self.map[start:start+length],
+                (socket.inet_ntoa(host), port))
+
+    def seek(self, timestamp):
+        """Index of the first record at or after timestamp"""
+        return bisect.bisect_left(self.times, timestamp)
+
+    def records(self, start=0, direction=None):
+        for index in xrange(start, len(self)):
+            record = self[index]
+            if direction is None or record[1] == direction:
+                yield record
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class Replayer(object):
+    """Feed recorded inbound datagrams back through a dispatcher
+
+    Datagrams are replayed as fast as possible. When a server is given, it
+    is updated once for every tick of recorded time that passes. clock gives
+    the recorded time of the datagram or tick being replayed, so a server
+    created with it times out and paces sends as it did when recorded.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.packets = 0
+        self.ticks = 0
+        self.elapsed = 0.0
+        self.now = reader.times[0] if len(reader) else 0.0
+
+    def clock(self):
+        return self.now
+
+    def replay(self, dispatcher, server=None, tick=1/20.0, start=0):
+        begin = time.time()
+        next_tick = None
+        for now, direction, data, address in \
+                self.reader.records(start, REC_IN):
+            if server is not None:
+                if next_tick is None:
+                    next_tick = now + tick
+                while now >= next_tick:
+                    self.now = next_tick
+                    server.update(tick)
+                    self.ticks += 1
+                    next_tick += tick
+            self.now = now
+            dispatcher.dispatch(data, address)
+            self.packets += 1
+        self.elapsed = time.time() - begin
+        return self.packets, self.ticks, self.elapsed
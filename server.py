@@ -12,37 +12,45 @@ Game server
 import logging
 import math
 import random
+import time
 
-from protocol import command, dispatch
+from protocol import bundle, command, dispatch, reliable, session
 from protocol.local import *
-from util import IdentAlloc
+from entity import EntityStore
+from history import StateHistory
+from util import IdentAlloc, IdentFetchError
+import record
 import sockwrap
 import physics
 import vector
 
 logger = logging.getLogger(__name__)
 
+# Packets read from one address per tick, a few client frames' worth
+MAX_CLIENT_READS = 16
+
 class ServerBoxman(object):
-    """Server Boxman entity"""
+    """Server Boxman entity
+
+    Given a vector.HeadingTable, thrust is looked up for the nearest
+    quantized heading instead of computed with cos and sin.
+    """
+    __slots__ = ('id', 'color', 'forward', 'backward', 'rot_cw', 'rot_ccw',
+                 'held', 'body', 'headings')
     THRUST = 500.0
     ANGULAR_THRUST = 20.0
-    COLORS = (
-        (0, 0, 255),
-        (0, 255, 0),
-        (0, 255, 255),
-        (255, 0, 0),
-        (255, 0, 255),
-        (255, 255, 0),
-    )
-
-    def __init__(self, id):
+    COLORS = BOXMAN_COLORS
+
+    def __init__(self, id, headings=None):
         self.id = id
         self.color = random.choice(self.COLORS)
         self.forward = False
         self.backward = False
         self.rot_cw = False
         self.rot_ccw = False
+        self.held = None
         self.body = physics.Body(10.0, 10.0)
+        self.headings = headings
 
     def get_position(self):
         return self.body.position
@@ -56,22 +64,34 @@ class ServerBoxman(object):
     def get_angle(self):
         return self.body.angle
 
-    def set_movement(self, movement):
+    def set_movement(self, movement, held=None):
+        """Set movement state, with controls held only for the next update"""
         self.forward, self.backward, self.rot_cw, self.rot_ccw = movement
+        self.held = held
+
+    def thrust(self):
+        if self.headings is None:
+            return vector.Vec2.from_angle(-self.get_angle(), self.THRUST)
+        heading = -self.headings.heading(self.get_angle())
+        return self.headings.vector(heading, self.THRUST)
 
     def update(self, dt):
+        forward, backward, rot_cw, rot_ccw = \
+                self.forward, self.backward, self.rot_cw, self.rot_ccw
+        if self.held is not None:
+            forward, backward, rot_cw, rot_ccw = self.held
+            self.held = None
         force = vector.Vec2()
         angular_force = 0.0
-        if self.rot_cw:
+        if rot_cw:
             angular_force += self.ANGULAR_THRUST
-        if self.rot_ccw:
+        if rot_ccw:
             angular_force -= self.ANGULAR_THRUST
-        if self.forward:
-            force = force + \
-                    vector.Vec2.from_angle(-self.get_angle(), self.THRUST)
-        if self.backward:
-            force = force - \
-                    vector.Vec2.from_angle(-self.get_angle(), self.THRUST)
+        if forward != backward:
+            if forward:
+                force = self.thrust()
+            else:
+                force = force - self.thrust()
         self.body.reset_force()
         self.body.add_force(force)
         self.body.reset_torque()
@@ -84,25 +104,104 @@ class ServerBoxman(object):
 class Server(object):
     """Handle updating entities and socket server"""
     def __init__(self, sock_server, quitcmd, spawncmd, destroycmd, updatecmd,
-                 players, idalloc):
+                 entities, idalloc, reliablepack, inputs, history,
+                 welcomecmd, sessions, tokenalloc, bundlepacks, send_pool=None,
+                 timeout=10.0, headings=None, clock=time.time):
         self.sock_server = sock_server
         self.quitcmd = quitcmd
         self.spawncmd = spawncmd
         self.destroycmd = destroycmd
         self.updatecmd = updatecmd
-        self.players = players
+        self.entities = entities
         self.idalloc = idalloc
+        self.reliablepack = reliablepack
+        self.inputs = inputs
+        self.history = history
+        self.welcomecmd = welcomecmd
+        self.sessions = sessions
+        self.tokenalloc = tokenalloc
+        self.bundlepacks = bundlepacks
+        self.seen_ticks = {}
+        self.send_pool = send_pool
+        self.timeout = timeout
+        self.headings = headings
+        self.clock = clock
+        self.last_seen = {}
+        self.evictions = 0
+        self.ticks = 0
+        self.tick_time = 0.0
+        self.tick_total = 0.0
+        self.tick_max = 0.0
+
+    def average_tick_time(self):
+        if self.ticks < 1:
+            return 0.0
+        return self.tick_total / self.ticks
+
+    def received_header(self, data, address):
+        """Note any packet from a known client as a sign of life"""
+        if address in self.last_seen:
+            self.last_seen[address] = self.clock()
+
+    def remove_player(self, address):
+        oldid = self.entities.addresses[address]
+        self.entities.remove(oldid)
+        self.idalloc.free(oldid)
+        del self.last_seen[address]
+        self.seen_ticks.pop(address, None)
+        # Get anything bundled for the client out before its state goes
+        for bundlepack in self.bundlepacks:
+            bundlepack.flush(address)
+        token = self.sessions.forget(address)
+        if token is not None:
+            self.tokenalloc.free(token)
+        self.reliablepack.channels.forget(address)
+        self.sock_server.queue.forget(address)
+        for sendto in self.entities.addresses.iterkeys():
+            self.destroycmd.send(oldid, sendto)
+
+    def evict(self):
+        """Remove clients not heard from within the timeout"""
+        now = self.clock()
+        expired = [address for address, seen in self.last_seen.iteritems()
+                   if now - seen > self.timeout]
+        for address in expired:
+            logger.debug("Evict:Client %s timed out", repr(address))
+            self.remove_player(address)
+            self.evictions += 1
+        # Drop state for addresses that never said hello or are long gone
+        self.reliablepack.channels.expire(now, self.timeout)
+        self.sock_server.queue.expire(now, self.timeout)
+
+    def welcome(self, version, capabilities, dictionary, address):
+        """Negotiate protocol version and capabilities with new client"""
+        version, capabilities = self.sessions.negotiate(address, version,
+                                                        capabilities,
+                                                        dictionary)
+        token = None
+        if capabilities & CAP_COMPACT_HEADER:
+            try:
+                token = self.tokenalloc.fetch()
+                self.sessions.assign(address, token)
+            except IdentFetchError:
+                logger.debug("Hello:No session tokens left")
+        self.welcomecmd.send(version, capabilities, token, address)
+        logger.debug("Hello:Version %d:Capabilities 0x%04x",
+                     version, capabilities)
 
-    def on_hello(self, address):
-        if address not in self.players:
+    def on_hello(self, version, capabilities, dictionary, address):
+        if address not in self.entities.addresses:
             newid = self.idalloc.fetch()
-            boxman = ServerBoxman(newid)
-            for sendto, player in self.players.iteritems():
-                # Notify new player of existing players
-                self.spawncmd.send(ENT_BOXMAN, player, address)
-                # Notify existing players of new player
+            boxman = ServerBoxman(newid, self.headings)
+            self.welcome(version, capabilities, dictionary, address)
+            # Notify new player of existing entities
+            for entity in self.entities:
+                self.spawncmd.send(ENT_BOXMAN, entity, address)
+            # Notify existing players of new player
+            for sendto in self.entities.addresses.iterkeys():
                 self.spawncmd.send(ENT_BOXMAN, boxman, sendto)
-            self.players[address] = boxman
+            self.entities.add(boxman, address)
+            self.last_seen[address] = self.clock()
             # Notify new player of its entity
             self.spawncmd.send(ENT_PLAYER, boxman, address)
             logger.debug("Hello:New client:%s", repr(address))
@@ -110,57 +209,188 @@ class Server(object):
             logger.debug("Hello:Client already known")
 
     def on_quit(self, address):
-        if address in self.players:
-            oldid = self.players[address].id
-            self.idalloc.free(oldid)
-            del self.players[address]
+        if address in self.entities.addresses:
             self.quitcmd.send(address)
+            self.remove_player(address)
             logger.debug("Quit:Client %s", repr(address))
-            for address in self.players.iterkeys():
-                self.destroycmd.send(oldid, address)
         else:
             logger.debug("Quit:Client unknown")
 
-    def on_client(self, movement, address):
-        if address not in self.players:
+    def on_client(self, movement, held, tick, address):
+        if address not in self.entities.addresses:
             logger.debug("Client:Client unknown")
             return
-        self.players[address].set_movement(movement)
+        self.entities.by_address(address).set_movement(movement, held)
+        self.seen_ticks[address] = tick
+
+    def seen_position(self, address, id):
+        """Position of entity as last seen by the client at address
+
+        Lag compensated interactions should check against this rather than
+        the current position. Falls back to the current position when the
+        tick the client saw is no longer in the history.
+        """
+        try:
+            return self.history.position_at_tick(id,
+                                                 self.seen_ticks[address])
+        except KeyError:
+            return self.entities.get(id).get_position()
+
+    def send_updates(self):
+        if self.send_pool is None:
+            for address in self.entities.addresses.iterkeys():
+                self.updatecmd.send(self.entities.fields, address,
+                                    self.ticks)
+            return
+        # Don't let a slow tick's sends pile up behind the next one
+        self.send_pool.wait()
+        snapshot = self.entities.fields.copy()
+        for address in self.entities.addresses.iterkeys():
+            self.send_pool.submit(self.updatecmd.send, snapshot, address,
+                                  self.ticks)
+
+    def bundle_stats(self):
+        """Commands, packets, bytes before and after bundling, compressed"""
+        return tuple(sum(stats) for stats in zip(*[
+                (bundlepack.commands, bundlepack.packets,
+                 bundlepack.raw_bytes, bundlepack.sent_bytes,
+                 bundlepack.compressed)
+                for bundlepack in self.bundlepacks]))
+
+    def send_stats(self):
+        """Pool stalls, queue drops and supersedes, resends, losses, abandons"""
+        channels = self.reliablepack.channels
+        queue = self.sock_server.queue
+        stalls = self.send_pool.stalls if self.send_pool is not None else 0
+        return (stalls, queue.dropped, queue.superseded, channels.resent,
+                channels.lost, channels.abandoned)
+
+    def close(self):
+        if self.send_pool is not None:
+            self.send_pool.close()
 
     def update(self, dt):
-        for player in self.players.itervalues():
-            player.update(dt)
-        for address in self.players.iterkeys():
-            self.updatecmd.send(self.players.values(), address)
+        start = time.time()
+        self.evict()
+        self.inputs.flush()
+        for entity in self.entities:
+            entity.update(dt)
+        self.entities.sync()
+        self.history.record(self.ticks, self.clock(), self.entities)
+        self.send_updates()
+        for bundlepack in self.bundlepacks:
+            bundlepack.flush()
+        self.reliablepack.update()
         self.sock_server.update()
+        self.tick_time = time.time() - start
+        self.tick_total += self.tick_time
+        self.tick_max = max(self.tick_max, self.tick_time)
+        self.ticks += 1
+
+def create_server(address, port=11235, send_workers=0, timeout=10.0,
+                  recorder=None, headless=False, history_size=32,
+                  heading_steps=0, dictionary="", sock=None, loopback=None,
+                  clock=time.time):
+    """Server creation factory method
 
-def create_server(address, port=11235):
-    """Server creation factory method"""
-    players = {}
+    With send_workers above zero, update packets are encoded and sent from
+    a pool of that many threads instead of the simulation thread. Clients
+    not heard from for timeout seconds are evicted. Traffic is written to
+    recorder when given. A headless server has no real socket and discards
+    anything it sends. The last history_size ticks of entity positions are
+    kept for lag compensation. With heading_steps above zero, boxmen thrust
+    along headings quantized to that many steps using precomputed tables.
+    Commands to each client are bundled per tick and compressed with
+    dictionary when the client has the same one. A stand-in socket, such as
+    one from a MemoryNetwork, can be given in place of a real one. With a
+    loopback MemoryNetwork, in-process clients reach the server in memory
+    at LOOPBACK_HOST on port while others still use the real socket.
+    Timeouts, eviction and send pacing follow clock, which gives the time
+    in seconds.
+    """
+    entities = EntityStore(256)
     idalloc = IdentAlloc(256)
-    sock_writequeue = sockwrap.SocketWriteQueue()
-    headpack = command.HeaderPack(sock_writequeue)
-    cmdpack = command.CommandPack(headpack)
+    history = StateHistory(history_size, 256)
+    compressor = bundle.Compressor(dictionary)
+    sessions = session.Sessions(compressor.crc)
+    tokenalloc = IdentAlloc(MAX_TOKENS)
+    headings = None
+    if heading_steps > 0:
+        headings = vector.HeadingTable(heading_steps)
+        logger.debug("Quantized headings:%d steps:thrust error %.3f",
+                     heading_steps, headings.error() * ServerBoxman.THRUST)
+    sock_writequeue = sockwrap.SocketWriteQueue(clock=clock)
+    channels = reliable.ReliableChannels(sock_writequeue.congestion, clock)
+    writequeue = sock_writequeue
+    if recorder is not None:
+        writequeue = record.RecordingWriteQueue(sock_writequeue, recorder)
+    headpack = command.HeaderPack(writequeue, sessions)
+    reliablepack = reliable.ReliablePack(headpack, channels)
+    bundlepack = bundle.BundlePack(reliablepack, sessions, compressor)
+    bundlepacks = [bundlepack]
+    cmdpack = command.CommandPack(bundlepack)
     quitcmd = command.QuitCommand(cmdpack)
     spawncmd = command.SpawnCommand(cmdpack)
     destroycmd = command.DestroyCommand(cmdpack)
     updatecmd = command.UpdateCommand(cmdpack)
+    welcomecmd = command.WelcomeCommand(cmdpack)
     hello_dispatcher = dispatch.HelloDispatch()
     quit_dispatcher = dispatch.QuitDispatch()
-    client_dispatcher = dispatch.ClientDispatch(players)
+    client_dispatcher = dispatch.ClientDispatch(entities.addresses)
+    bundle_dispatcher = bundle.BundleDispatch(compressor, sessions)
 
     cmd_dispatcher = dispatch.CommandDispatch()
     cmd_dispatcher.push_handlers(received_hello=hello_dispatcher.dispatch,
                                  received_quit=quit_dispatcher.dispatch,
-                                 received_client=client_dispatcher.dispatch)
-    header_dispatcher = dispatch.HeaderDispatch()
-    header_dispatcher.push_handlers(received_header=cmd_dispatcher.dispatch)
+                                 received_client=client_dispatcher.dispatch,
+                                 received_bundle=bundle_dispatcher.dispatch)
+    bundle_dispatcher.push_handlers(received_packet=cmd_dispatcher.dispatch)
+    reliable_dispatcher = reliable.ReliableDispatch(channels)
+    reliable_dispatcher.push_handlers(received_packet=cmd_dispatcher.dispatch)
+    header_dispatcher = dispatch.HeaderDispatch(sessions)
+    header_dispatcher.push_handlers(
+            received_header=reliable_dispatcher.dispatch)
 
-    sock_dispatcher = sockwrap.SocketReadDispatch(header_dispatcher)
-    sock = sockwrap.create_server_socket(address, port)
-    sock_server = sockwrap.SocketServer(sock_dispatcher, sock_writequeue, sock)
+    read_dispatcher = header_dispatcher
+    if recorder is not None:
+        read_dispatcher = record.RecordingReadDispatch(header_dispatcher,
+                                                       recorder)
+    sock_dispatcher = sockwrap.SocketReadDispatch(read_dispatcher,
+                                                  MAX_CLIENT_READS)
+    if sock is None and headless:
+        sock = sockwrap.NullSocket()
+    if sock is not None:
+        sock_server = sockwrap.VirtualSocketServer(sock_dispatcher,
+                                                   sock_writequeue, sock)
+    elif loopback is not None:
+        sock = loopback.socket((sockwrap.LOOPBACK_HOST, port),
+                               sockwrap.create_server_socket(address, port))
+        sock_server = sockwrap.LoopbackSocketServer(sock_dispatcher,
+                                                    sock_writequeue, sock)
+    else:
+        sock = sockwrap.create_server_socket(address, port)
+        sock_server = sockwrap.SocketServer(sock_dispatcher, sock_writequeue,
+                                            sock)
+    send_pool = None
+    if send_workers > 0:
+        send_pool = sockwrap.SocketSendPool(sock_writequeue, sock,
+                                              send_workers)
+        poolqueue = send_pool
+        if recorder is not None:
+            poolqueue = record.RecordingWriteQueue(send_pool, recorder)
+        # Each update goes out on its own from the worker that encoded it
+        pool_bundlepack = bundle.BundlePack(
+                reliable.ReliablePack(
+                        command.HeaderPack(poolqueue, sessions), channels),
+                sessions, compressor, buffering=False)
+        bundlepacks.append(pool_bundlepack)
+        updatecmd = command.UpdateCommand(
+                command.CommandPack(pool_bundlepack))
     server = Server(sock_server, quitcmd, spawncmd, destroycmd, updatecmd,
-                    players, idalloc)
+                    entities, idalloc, reliablepack, client_dispatcher,
+                    history, welcomecmd, sessions, tokenalloc, bundlepacks,
+                    send_pool, timeout, headings, clock)
+    header_dispatcher.push_handlers(server)
     hello_dispatcher.push_handlers(server)
     quit_dispatcher.push_handlers(server)
     client_dispatcher.push_handlers(server)
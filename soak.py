@@ -0,0 +1,352 @@
+"""
+Soak test
+
+Drive a headless server for many ticks with synthetic clients joining,
+quitting and vanishing over an in-memory network. Memory use, live object
+counts and tick times are sampled as it runs, and the run fails when they
+grow past set thresholds between the first and last samples.
+
+Churn and input are driven by a seeded random generator and the server and
+clients run on a simulated clock advanced one tick at a time, so runs with
+the same seed see the same traffic. Only tick times are measured on the
+wall clock. Send workers make runs nondeterministic again.
+
+The quick profile (the default) runs 20000 ticks, about 17 minutes of play,
+which is enough to catch steady leaks. The long profile runs two million
+ticks, over a day of play, for slow growth and counter wrap around.
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import collections
+import gc
+import logging
+import optparse
+import random
+import resource
+import sys
+
+from client import create_client
+from server import create_server
+import sockwrap
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("soak")
+
+SERVER_ADDRESS = ("10.0.0.1", 11235)
+# Ticks and sample interval for each run profile
+PROFILES = {
+    "quick": (20000, 1000),
+    "long": (2000000, 50000),
+}
+
+def rss():
+    """Resident set size in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize()
+    except (IOError, OSError):
+        # Peak rather than current size, which still shows growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def object_counts():
+    """Count live objects tracked by the garbage collector by type name"""
+    gc.collect()
+    counts = collections.defaultdict(int)
+    for obj in gc.get_objects():
+        counts[type(obj).__name__] += 1
+    return counts
+
+class SimulatedClock(object):
+    """Clock that only moves when advanced"""
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, dt):
+        self.now += dt
+
+class HeadlessBoxman(object):
+    """Client entity stand-in without graphics"""
+    def __init__(self):
+        self.position = (0.0, 0.0)
+        self.velocity = (0.0, 0.0)
+        self.rotation = 0.0
+
+    def set_position(self, x, y):
+        self.position = (x, y)
+
+    def set_velocity(self, x, y):
+        self.velocity = (x, y)
+
+    def update(self, dt):
+        pass
+
+class HeadlessAssets(object):
+    """Client assets stand-in without graphics"""
+    def start(self):
+        pass
+
+    def boxman(self, color):
+        return HeadlessBoxman()
+
+    def draw(self):
+        pass
+
+class Sample(object):
+    """Measurements at the end of a window of ticks"""
+    def __init__(self, tick, times, server, network, clients):
+        self.tick = tick
+        self.rss = rss()
+        self.p50 = percentile(times, 0.5)
+        self.p99 = percentile(times, 0.99)
+        self.max = max(times) if times else 0.0
+        self.counts = object_counts()
+        self.objects = sum(self.counts.itervalues())
+        self.clients = clients
+        self.entities = len(server.entities)
+        self.channels = len(server.reliablepack.channels.channels)
+        self.rates = len(server.sock_server.queue.rates)
+        self.tokens = len(server.sessions.tokens)
+        self.evictions = server.evictions
+        self.dropped = network.dropped
+        self.received = server.sock_server.socks[0].received
+        (self.stalls, self.queue_dropped, self.superseded, self.resent,
+         self.lost, self.abandoned) = server.send_stats()
+        (self.commands, self.packets, self.raw_bytes, self.sent_bytes,
+         self.compressed) = server.bundle_stats()
+
+    def log(self):
+        logger.info("Tick %d:rss %.1fMB:objects %d:tick p50 %.3fms "
+                    "p99 %.3fms max %.3fms", self.tick,
+                    self.rss / 1048576.0, self.objects, self.p50 * 1000.0,
+                    self.p99 * 1000.0, self.max * 1000.0)
+        logger.info("Tick %d:clients %d:entities %d:channels %d:rates %d:"
+                    "tokens %d:network dropped %d", self.tick, self.clients,
+                    self.entities, self.channels, self.rates, self.tokens,
+                    self.dropped)
+        logger.info("Tick %d:evictions %d:stalls %d:queue dropped %d "
+                    "superseded %d:resent %d lost %d abandoned %d", self.tick,
+                    self.evictions, self.stalls, self.queue_dropped,
+                    self.superseded, self.resent, self.lost, self.abandoned)
+        logger.info("Tick %d:commands %d:packets %d:compressed %d:"
+                    "bytes %d sent %d", self.tick, self.commands, self.packets,
+                    self.compressed, self.raw_bytes, self.sent_bytes)
+
+class Soak(object):
+    """Run a server against churning synthetic clients"""
+    def __init__(self, max_clients=32, join_rate=0.2, leave_rate=0.05,
+                 vanish=0.25, move_rate=0.1, timeout=1.0, send_workers=0,
+                 seed=0):
+        self.max_clients = max_clients
+        self.join_rate = join_rate
+        self.leave_rate = leave_rate
+        self.vanish = vanish
+        self.move_rate = move_rate
+        self.random = random.Random(seed)
+        # Spawn positions and colors come from the global generator
+        random.seed(seed)
+        self.clock = SimulatedClock()
+        self.network = sockwrap.MemoryNetwork()
+        self.peak_entities = 0
+        self.server = create_server(SERVER_ADDRESS[0], SERVER_ADDRESS[1],
+                                    send_workers, timeout,
+                                    sock=self.network.socket(SERVER_ADDRESS),
+                                    clock=self.clock)
+        self.clients = []
+        self.joins = 0
+        self.quits = 0
+        self.vanished = 0
+
+    def join(self):
+        client = create_client(SERVER_ADDRESS[0], SERVER_ADDRESS[1],
+                               sock=self.network.socket(),
+                               assets=HeadlessAssets(), clock=self.clock)
+        client.send_hello()
+        self.clients.append(client)
+        self.joins += 1
+
+    def leave(self, client):
+        """Quit, or vanish so the server has to evict the client"""
+        if self.random.random() < self.vanish:
+            self.vanished += 1
+        else:
+            client.send_quit()
+            client.update(0.0)
+            self.quits += 1
+        self.clients.remove(client)
+        for sock in client.sock_server.socks:
+            sock.close()
+
+    def move(self, client):
+        flags = [self.random.random() < 0.5 for n in range(4)]
+        client.stop_move(True, True, True, True)
+        client.start_move(*flags)
+
+    def tick(self, dt):
+        self.clock.advance(dt)
+        if len(self.clients) < self.max_clients and \
+                self.random.random() < self.join_rate:
+            self.join()
+        if self.clients and self.random.random() < self.leave_rate:
+            self.leave(self.random.choice(self.clients))
+        for client in self.clients:
+            if self.random.random() < self.move_rate:
+                self.move(client)
+            client.update(dt)
+        self.server.update(dt)
+        self.peak_entities = max(self.peak_entities,
+                                 len(self.server.entities))
+
+    def run(self, ticks, interval, dt=1/20.0):
+        """Run for ticks, sampling every interval ticks"""
+        samples = []
+        times = []
+        for tick in xrange(1, ticks + 1):
+            self.tick(dt)
+            times.append(self.server.tick_time)
+            if tick % interval == 0:
+                sample = Sample(tick, times, self.server, self.network,
+                                len(self.clients))
+                sample.log()
+                samples.append(sample)
+                times = []
+        return samples
+
+    def close(self):
+        self.server.close()
+
+def check_load(soak, samples):
+    """Check the run exercised the server, returning failures
+
+    Growth measured without clients, entities or traffic means nothing, so
+    this should pass before check is trusted. Traffic has to keep flowing
+    after the first sample, which is the baseline check compares against.
+    """
+    if len(samples) < 2:
+        return ["not enough samples"]
+    first, last = samples[0], samples[-1]
+    failures = []
+    if soak.joins < 1:
+        failures.append("no clients joined")
+    if soak.peak_entities < 1:
+        failures.append("no entities spawned")
+    if last.clients > 0 and last.entities < 1:
+        failures.append("%d clients but no entities" % last.clients)
+    if last.packets <= first.packets:
+        failures.append("server sent no packets after tick %d" % first.tick)
+    if last.received <= first.received:
+        failures.append("server received no packets after tick %d" %
+                        first.tick)
+    if soak.quits + soak.server.evictions < 1:
+        failures.append("no clients quit or were evicted")
+    return failures
+
+def check(samples, max_rss_growth, max_tick_growth, max_object_growth,
+          min_tick=0.001):
+    """Compare the last sample to the first, returning failures
+
+    The first sample is taken as the baseline, so it should come after the
+    server has warmed up. Tick time growth is only counted once the last
+    p99 is above min_tick seconds, below which it is mostly noise.
+    """
+    if len(samples) < 2:
+        return ["not enough samples"]
+    first, last = samples[0], samples[-1]
+    failures = []
+    rss_growth = (last.rss - first.rss) / 1048576.0
+    if rss_growth > max_rss_growth:
+        failures.append("rss grew %.1fMB" % rss_growth)
+    if last.p99 > min_tick and last.p99 > first.p99 * max_tick_growth:
+        failures.append("tick p99 grew from %.3fms to %.3fms" %
+                        (first.p99 * 1000.0, last.p99 * 1000.0))
+    object_growth = last.objects - first.objects
+    if object_growth > max_object_growth:
+        failures.append("%d more live objects" % object_growth)
+    growth = sorted(((count - first.counts.get(name, 0), name)
+                     for name, count in last.counts.iteritems()),
+                    reverse=True)
+    for count, name in growth[:10]:
+        if count > 0:
+            logger.info("Growth:%s:%d", name, count)
+    return failures
+
+def parse_arguments():
+    parser = optparse.OptionParser()
+    parser.add_option("-p", "--profile", type="choice", dest="profile",
+                      choices=sorted(PROFILES), default="quick",
+                      help="run the quick or long profile of ticks and "
+                           "sample interval, default quick")
+    parser.add_option("-n", "--ticks", type="int", dest="ticks",
+                      help="run for TICKS server ticks instead")
+    parser.add_option("-i", "--interval", type="int", dest="interval",
+                      help="sample every INTERVAL ticks instead")
+    parser.add_option("-c", "--clients", type="int", dest="clients",
+                      default=32, help="keep at most CLIENTS clients")
+    parser.add_option("-j", "--join-rate", type="float", dest="join_rate",
+                      default=0.2, help="chance of a client joining "
+                              "each tick")
+    parser.add_option("-l", "--leave-rate", type="float", dest="leave_rate",
+                      default=0.05, help="chance of a client leaving "
+                              "each tick")
+    parser.add_option("-v", "--vanish", type="float", dest="vanish",
+                      default=0.25, help="chance a leaving client goes "
+                              "silent instead of quitting")
+    parser.add_option("-t", "--timeout", type="float", dest="timeout",
+                      default=1.0, help="evict clients silent for TIMEOUT "
+                              "seconds")
+    parser.add_option("-w", "--send-workers", type="int", dest="send_workers",
+                      default=0, help="encode and send server updates from "
+                              "a pool of SEND_WORKERS threads")
+    parser.add_option("-s", "--seed", type="int", dest="seed", default=0,
+                      help="seed churn and input with SEED")
+    parser.add_option("--max-rss-growth", type="float", dest="max_rss_growth",
+                      default=16.0, help="fail if RSS grows over MB",
+                      metavar="MB")
+    parser.add_option("--max-tick-growth", type="float",
+                      dest="max_tick_growth", default=2.0,
+                      help="fail if tick p99 grows over FACTOR times",
+                      metavar="FACTOR")
+    parser.add_option("--max-object-growth", type="int",
+                      dest="max_object_growth", default=10000,
+                      help="fail if live objects grow over COUNT",
+                      metavar="COUNT")
+    (options, args) = parser.parse_args()
+    ticks, interval = PROFILES[options.profile]
+    if options.ticks is not None:
+        ticks = options.ticks
+    if options.interval is not None:
+        interval = options.interval
+    soak = Soak(options.clients, options.join_rate, options.leave_rate,
+                options.vanish, timeout=options.timeout,
+                send_workers=options.send_workers, seed=options.seed)
+    try:
+        samples = soak.run(ticks, interval)
+    finally:
+        soak.close()
+    logger.info("%d joins, %d quits, %d vanished, %d evicted", soak.joins,
+                soak.quits, soak.vanished, soak.server.evictions)
+    failures = check_load(soak, samples)
+    if not failures:
+        failures = check(samples, options.max_rss_growth,
+                         options.max_tick_growth, options.max_object_growth)
+    for failure in failures:
+        logger.error("Failed:%s", failure)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(parse_arguments())
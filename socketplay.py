@@ -13,70 +13,135 @@ Simple client/server python game.
 
 import logging
 import optparse
+import zlib
 
 import pyglet
 
 from client import create_client
 from server import create_server
+from protocol import bundle
+import record
+import sockwrap
 
 logging.basicConfig(level=logging.DEBUG)
 
-class MainWindow(pyglet.window.Window):
-    def __init__(self, client):
-        super(MainWindow, self).__init__()
-        self.clock = pyglet.clock.ClockDisplay()
-        self.client = client
+def replay(path, send_workers=0):
+    """Replay a recording into a headless server as fast as possible
 
-    def on_key_press(self, symbol, modifiers):
-        if symbol == pyglet.window.key.UP:
-            self.client.start_move(forward=True)
-        elif symbol == pyglet.window.key.DOWN:
-            self.client.start_move(backward=True)
-        elif symbol == pyglet.window.key.LEFT:
-            self.client.start_move(rot_ccw=True)
-        elif symbol == pyglet.window.key.RIGHT:
-            self.client.start_move(rot_cw=True)
-        elif symbol == pyglet.window.key.ESCAPE:
-            self.client.send_quit()
+    The server runs on the recording's clock rather than the wall clock.
+    """
+    logging.debug("Replay %s", path)
+    reader = record.RecordReader(path)
+    replayer = record.Replayer(reader)
+    server = create_server("0.0.0.0", send_workers=send_workers,
+                           headless=True, clock=replayer.clock)
+    try:
+        replayer.replay(server.sock_server.dispatcher.dispatcher, server)
+    finally:
+        server.close()
+        reader.close()
+    logging.info("Replayed %d packets over %d ticks in %.3fs",
+                 replayer.packets, replayer.ticks, replayer.elapsed)
+    logging.info("Server tick time:average %.3fms:max %.3fms",
+                 server.average_tick_time() * 1000.0,
+                 server.tick_max * 1000.0)
 
-    def on_key_release(self, symbol, modifiers):
-        if symbol == pyglet.window.key.UP:
-            self.client.stop_move(forward=True)
-        elif symbol == pyglet.window.key.DOWN:
-            self.client.stop_move(backward=True)
-        elif symbol == pyglet.window.key.LEFT:
-            self.client.stop_move(rot_ccw=True)
-        elif symbol == pyglet.window.key.RIGHT:
-            self.client.stop_move(rot_cw=True)
+def train_dictionary(recording, path, recorded_dictionary=""):
+    """Build a compression dictionary from commands sent in a recording
 
-    def on_client_quit(self):
-        pyglet.app.event_loop.exit()
+    Bundles in the recording are inflated with recorded_dictionary, the
+    dictionary it was made with.
+    """
+    compressor = bundle.Compressor(recorded_dictionary)
+    reader = record.RecordReader(recording)
+    samples = []
+    packets = skipped = 0
+    try:
+        for now, direction, data, address in \
+                reader.records(direction=record.REC_OUT):
+            try:
+                samples.extend(bundle.bundle_samples(data, compressor))
+                packets += 1
+            except zlib.error:
+                skipped += 1
+    finally:
+        reader.close()
+    if skipped:
+        logging.warning("Skipped %d packets that didn't inflate, was the "
+                        "recording made with another dictionary?", skipped)
+    dictionary = bundle.build_dictionary(samples)
+    with open(path, "wb") as f:
+        f.write(dictionary)
+    logging.info("Trained %d byte dictionary from %d commands in %d packets "
+                 "into %s", len(dictionary), len(samples), packets, path)
 
-    def on_close(self):
-        self.client.send_quit()
-        return pyglet.event.EVENT_HANDLED
+def load_dictionary(path):
+    if path is None:
+        return ""
+    with open(path, "rb") as f:
+        return f.read()
 
-    def on_draw(self):
-        self.clear()
-        self.client.draw()
-        self.clock.draw()
-
-def start(server=True, address="localhost", port=11235):
+def start(server=True, address="localhost", port=11235, send_workers=0,
+          timeout=10.0, record_path=None, heading_steps=0,
+          dictionary=""):
     """Entry point"""
     pyglet.resource.path = ['res', 'res/images']
     pyglet.resource.reindex()
+    recorder = client_recorder = None
+    loopback = client_sock = None
+    if record_path is not None:
+        logging.debug("Record to %s", record_path)
+        recorder = client_recorder = record.Recorder(record_path)
     if server:
         logging.debug("Start server")
-        server = create_server("0.0.0.0", port)
+        loopback = sockwrap.MemoryNetwork(sockwrap.LOOPBACK_HOST)
+        server = create_server("0.0.0.0", port, send_workers, timeout,
+                               recorder, heading_steps=heading_steps,
+                               dictionary=dictionary, loopback=loopback)
         pyglet.clock.schedule_interval(server.update, 1/20.0)
+        # Only record the server side of a listen server
+        client_recorder = None
+        # The local client talks to the server in memory
+        address = sockwrap.LOOPBACK_HOST
+        client_sock = loopback.socket()
     logging.debug("Start client")
-    client = create_client(address, port)
+    client = create_client(address, port, client_recorder, dictionary,
+                           client_sock)
     client.send_hello()
+    client.assets.start()
     pyglet.clock.schedule_interval(client.update, 1/60.0)
     logging.debug("Open window")
+    # Only pull in the window and graphics once the handshake is under way
+    from window import MainWindow
     window = MainWindow(client)
     client.push_handlers(window)
     pyglet.app.run()
+    if server:
+        server.close()
+        logging.debug("Server tick time:average %.3fms:max %.3fms:%d ticks",
+                      server.average_tick_time() * 1000.0,
+                      server.tick_max * 1000.0, server.ticks)
+        logging.debug("Server evicted %d timed out clients",
+                      server.evictions)
+        logging.debug("Server dropped %d packets over the per client "
+                      "read limit", server.sock_server.dispatcher.dropped)
+        logging.debug("Server loopback delivered %d packets, dropped %d",
+                      loopback.delivered, loopback.dropped)
+        commands, packets, raw_bytes, sent_bytes, compressed = \
+                server.bundle_stats()
+        logging.debug("Server sent %d commands in %d packets, %d compressed",
+                      commands, packets, compressed)
+        logging.debug("Server sent %d command bytes as %d bytes",
+                      raw_bytes, sent_bytes)
+        stalls, dropped, superseded, resent, lost, abandoned = \
+                server.send_stats()
+        logging.debug("Server send pool stalled %d times", stalls)
+        logging.debug("Server write queue dropped %d packets, superseded %d",
+                      dropped, superseded)
+        logging.debug("Server resent %d reliable packets, %d lost, "
+                      "%d abandoned", resent, lost, abandoned)
+    if recorder is not None:
+        recorder.close()
 
 def parse_arguments():
     parser = optparse.OptionParser()
@@ -91,8 +156,51 @@ def parse_arguments():
                               "or connect to")
     parser.add_option("-p", "--port", type="int", dest="port", default=11235,
                       help="set port to listen or connect to")
+    parser.add_option("-w", "--send-workers", type="int", dest="send_workers",
+                      default=0, help="encode and send server updates from "
+                              "a pool of SEND_WORKERS threads")
+    parser.add_option("-t", "--timeout", type="float", dest="timeout",
+                      default=10.0, help="evict clients silent for TIMEOUT "
+                              "seconds")
+    parser.add_option("-r", "--record", type="string", dest="record",
+                      help="record packets sent and received to FILE",
+                      metavar="FILE")
+    parser.add_option("--replay", type="string", dest="replay",
+                      help="replay packets received in FILE into a headless "
+                           "server as fast as possible", metavar="FILE")
+    parser.add_option("-q", "--heading-steps", type="int",
+                      dest="heading_steps", default=0,
+                      help="quantize boxman headings to HEADING_STEPS "
+                           "steps, a power of two")
+    parser.add_option("-d", "--dictionary", type="string",
+                      dest="dictionary", help="compress bundled commands "
+                              "with the dictionary in FILE", metavar="FILE")
+    parser.add_option("--train-dictionary", type="string",
+                      dest="train_dictionary", help="build the dictionary "
+                              "given by --dictionary from packets sent in "
+                              "RECORDING", metavar="RECORDING")
+    parser.add_option("--recorded-dictionary", type="string",
+                      dest="recorded_dictionary", help="inflate packets in "
+                              "the --train-dictionary recording with the "
+                              "dictionary in FILE it was made with",
+                      metavar="FILE")
     (options, args) = parser.parse_args()
-    start(server=options.server, address=options.address, port=options.port)
+    steps = options.heading_steps
+    if steps < 0 or steps & (steps - 1):
+        parser.error("--heading-steps must be a power of two")
+    if options.train_dictionary:
+        if not options.dictionary:
+            parser.error("--train-dictionary needs --dictionary")
+        train_dictionary(options.train_dictionary, options.dictionary,
+                         load_dictionary(options.recorded_dictionary))
+        return
+    if options.replay:
+        replay(options.replay, send_workers=options.send_workers)
+        return
+    start(server=options.server, address=options.address, port=options.port,
+          send_workers=options.send_workers, timeout=options.timeout,
+          record_path=options.record, heading_steps=options.heading_steps,
+          dictionary=load_dictionary(options.dictionary))
 
 if __name__ == "__main__":
     parse_arguments()
@@ -9,8 +9,20 @@ Light UDP socket wrapper.
 # To Public License, Version 2, as published by Sam Hocevar. See
 # http://sam.zoy.org/wtfpl/COPYING for more details.
 
+import Queue
+import collections
+import errno
+import logging
 import select
 import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Host for in-process peers of a real socket, which no real datagram can
+# come from
+LOOPBACK_HOST = "0.0.0.0"
 
 def create_server_socket(address, port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -23,49 +35,480 @@ def create_client_socket():
     sock.setblocking(0)
     return sock
 
+def resolve_address(address, port):
+    """Resolve host name so it matches addresses packets are received from"""
+    return (socket.gethostbyname(address), port)
+
 class SocketReadDispatch(object):
-    """Dispatch packet read from socket"""
-    def __init__(self, dispatcher):
+    """Dispatch packet read from socket
+
+    At most limit packets from an address are dispatched between resets.
+    The rest are read and dropped before any protocol work is done on them.
+    """
+    def __init__(self, dispatcher, limit=None):
         self.dispatcher = dispatcher
+        self.limit = limit
+        self.reads = {}
+        self.dropped = 0
+
+    def reset(self):
+        self.reads = {}
 
     def dispatch(self, sock):
+        """Read a packet, returning whether it was dispatched"""
         data, address = sock.recvfrom(4096)
+        if self.limit is not None:
+            reads = self.reads.get(address, 0)
+            if reads >= self.limit:
+                self.dropped += 1
+                return False
+            self.reads[address] = reads + 1
         self.dispatcher.dispatch(data, address)
+        return True
+
+class SendRate(object):
+    """Estimate the rate packets can be sent to a client
+
+    The rate grows additively while packets are acknowledged and halves
+    once per loss event. Losses of packets sent before the last halving are
+    part of the event that caused it, so an outage only halves the rate once
+    however many packets it took. Sending is paced by a token bucket refilled
+    at the current rate.
+    """
+    MIN_RATE = 5.0
+    MAX_RATE = 200.0
+    INCREASE = 1.0
+    BURST_TIME = 0.25
+
+    def __init__(self, rate=60.0, now=None):
+        self.rate = rate
+        self.rtt = None
+        self.losses = 0
+        self.tokens = self.burst()
+        if now is None:
+            now = time.time()
+        self.last = now
+        self.recovery = now
+
+    def burst(self):
+        return max(1.0, self.rate * self.BURST_TIME)
+
+    def on_ack(self, rtt):
+        """Packet was acknowledged after rtt seconds"""
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt = 0.875 * self.rtt + 0.125 * rtt
+        # Back off gently if queueing delay starts building
+        if rtt > 2.0 * self.rtt:
+            self.rate = max(self.MIN_RATE, self.rate * 0.875)
+        else:
+            self.rate = min(self.MAX_RATE, self.rate + self.INCREASE)
+
+    def on_loss(self, sent, now):
+        """Packet sent at time sent was lost or could not be sent"""
+        self.losses += 1
+        if sent < self.recovery:
+            return
+        self.rate = max(self.MIN_RATE, self.rate * 0.5)
+        self.recovery = now
+
+    def allow(self, now):
+        """Take a token if the rate allows sending a packet now"""
+        self.tokens = min(self.burst(),
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
 
 class SocketWriteQueue(object):
-    """Queue packets to be written to a socket"""
-    def __init__(self):
-        self.writequeue = []
+    """Queue packets to be written to a socket
+
+    Each address has its own bounded queue and send rate, so a slow client
+    only delays its own packets. A droppable packet (such as a snapshot)
+    replaces any droppable packets still queued for the same address.
+    Sending is paced by clock, which gives the time in seconds.
+
+    A packet may come with a stamp, called with the packet just before it
+    is written to fill in anything that depends on send order, such as
+    sequence numbers, and returning the packet to write. A packet that is
+    superseded or dropped instead has its stamp called with None, so the
+    layers above only account for packets that were sent.
+    """
+    def __init__(self, maxsize=256, rate=60.0, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.initial_rate = rate
+        self.writequeues = {}
+        self.rates = {}
+        self.forgotten = set()
+        self.order = collections.deque()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.superseded = 0
+
+    def congestion(self, address):
+        """Get the send rate estimate for address"""
+        try:
+            return self.rates[address]
+        except KeyError:
+            rate = self.rates[address] = SendRate(self.initial_rate,
+                                                  self.clock())
+            return rate
+
+    def forget(self, address):
+        """Discard state for address once its queue has drained"""
+        with self.lock:
+            self.forgotten.add(address)
+            if address not in self.writequeues:
+                self.__remove(address)
 
-    def push(self, data, address):
-        self.writequeue.append((data, address))
+    def expire(self, now, timeout):
+        """Discard state for addresses with nothing sent within timeout
+
+        Catches addresses sent to again after they were forgotten, such as
+        by retransmits to a client that has gone.
+        """
+        with self.lock:
+            for address, rate in self.rates.items():
+                if address not in self.writequeues and \
+                        now - rate.last > timeout:
+                    self.__remove(address)
+
+    def __remove(self, address):
+        self.forgotten.discard(address)
+        self.rates.pop(address, None)
+
+    def push(self, data, address, droppable=False, stamp=None):
+        discarded = []
+        with self.lock:
+            try:
+                queue = self.writequeues[address]
+            except KeyError:
+                queue = self.writequeues[address] = collections.deque()
+                if address not in self.order:
+                    self.order.append(address)
+            if droppable and queue:
+                discarded = [cmd for cmd in queue if cmd[1]]
+                if discarded:
+                    queue = collections.deque(cmd for cmd in queue
+                                              if not cmd[1])
+                    self.writequeues[address] = queue
+                    self.superseded += len(discarded)
+            if len(queue) >= self.maxsize:
+                discarded.append(self.__drop(queue))
+            queue.append((data, droppable, stamp))
+        for cmd in discarded:
+            if cmd[2] is not None:
+                cmd[2](None)
+
+    def __drop(self, queue):
+        """Drop the oldest droppable packet, or the oldest packet"""
+        self.dropped += 1
+        for index, cmd in enumerate(queue):
+            if cmd[1]:
+                del queue[index]
+                return cmd
+        return queue.popleft()
 
     def empty(self):
-        return len(self.writequeue) < 1
+        return len(self.writequeues) < 1
 
-    def write(self, sock):
+    def __pop(self, address, now):
+        """Pop next packet for address if its rate allows, else None"""
+        with self.lock:
+            queue = self.writequeues.get(address)
+            if not queue or not self.congestion(address).allow(now):
+                return None
+            cmd = queue.popleft()
+            if not queue:
+                del self.writequeues[address]
+                if address in self.forgotten:
+                    self.__remove(address)
+            return cmd
+
+    def __send(self, sock, cmd, address, now):
+        data, droppable, stamp = cmd
+        if stamp is not None:
+            data = stamp(data)
         try:
-            cmd = self.writequeue.pop(0)
-            sock.sendto(cmd[0], cmd[1])
-        except IndexError:
-            pass
+            sock.sendto(data, address)
+        except socket.error as e:
+            logger.debug("Write:Dropped packet to %s:%s", repr(address), e)
+            with self.lock:
+                self.congestion(address).on_loss(now, now)
+
+    def write(self, sock):
+        """Write one packet from the next address able to send
+
+        Returns False when no address can send right now.
+        """
+        now = self.clock()
+        for n in range(len(self.order)):
+            with self.lock:
+                if not self.order:
+                    return False
+                address = self.order[0]
+                self.order.rotate(-1)
+                if address not in self.writequeues:
+                    self.order.remove(address)
+                    continue
+            cmd = self.__pop(address, now)
+            if cmd is not None:
+                self.__send(sock, cmd, address, now)
+                return True
+        return False
+
+    def write_address(self, sock, address):
+        """Write as many packets for address as its rate allows"""
+        now = self.clock()
+        cmd = self.__pop(address, now)
+        while cmd is not None:
+            self.__send(sock, cmd, address, now)
+            cmd = self.__pop(address, now)
 
 class SocketServer(object):
-    """Handle socket and dispatch packets"""
+    """Handle socket and dispatch packets
+
+    Each update dispatches up to MAX_READS packets. Packets dropped by the
+    read dispatcher's per-address limit don't count, so one flooding peer
+    can't use up everyone's reads, but no more than MAX_RECVS are read.
+    """
+    MAX_READS = 256
+    MAX_RECVS = 4096
+
     def __init__(self, dispatcher, queue, sock):
         self.dispatcher = dispatcher
         self.queue = queue
         self.socks = (sock,)
 
+    def read(self, sock):
+        reads = 0
+        for n in range(self.MAX_RECVS):
+            try:
+                if self.dispatcher.dispatch(sock):
+                    reads += 1
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logger.debug("Read:%s", e)
+                return
+            if reads >= self.MAX_READS:
+                return
+
     def select(self):
         result = select.select(self.socks, self.socks, (), 0)
         sock_read, sock_write, sock_error = result
         for sock in sock_read:
-            self.dispatcher.dispatch(sock)
+            self.read(sock)
         for sock in sock_write:
-            self.queue.write(sock)
+            while self.queue.write(sock):
+                pass
 
     def update(self):
+        self.dispatcher.reset()
         self.select()
-        while not self.queue.empty():
-            self.select()
+
+class NullSocket(object):
+    """Socket stand-in that never receives and discards what is sent"""
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+
+    def recvfrom(self, size):
+        raise socket.error(errno.EAGAIN, "no data")
+
+    def sendto(self, data, address):
+        self.sent += 1
+        self.sent_bytes += len(data)
+        return len(data)
+
+class MemoryNetwork(object):
+    """In-process datagram network for stand-in sockets
+
+    Datagrams are delivered to the socket bound to the destination address
+    or silently dropped, like UDP. A socket holds at most maxsize unread
+    datagrams, past which new ones are dropped. Sockets bound to a free port
+    are given host.
+    """
+    FIRST_PORT = 49152
+
+    def __init__(self, host="127.0.0.1", maxsize=1024):
+        self.host = host
+        self.maxsize = maxsize
+        self.sockets = {}
+        self.lock = threading.Lock()
+        self.next_port = self.FIRST_PORT
+        self.delivered = 0
+        self.dropped = 0
+
+    def socket(self, address=None, sock=None):
+        """Bind a new socket, to a free port when address is None
+
+        With sock, the new socket reaches addresses off the network through
+        that real socket.
+        """
+        with self.lock:
+            while address is None:
+                candidate = (self.host, self.next_port)
+                self.next_port += 1
+                if self.next_port > 65535:
+                    self.next_port = self.FIRST_PORT
+                if candidate not in self.sockets:
+                    address = candidate
+            if address in self.sockets:
+                raise socket.error(errno.EADDRINUSE, "address in use")
+            if sock is None:
+                new = MemorySocket(self, address)
+            else:
+                new = LoopbackSocket(self, address, sock)
+            self.sockets[address] = new
+            return new
+
+    def bound(self, address):
+        return address in self.sockets
+
+    def deliver(self, data, source, address):
+        with self.lock:
+            sock = self.sockets.get(address)
+            if sock is None or len(sock.inbox) >= self.maxsize:
+                self.dropped += 1
+                return
+            sock.inbox.append((data, source))
+            self.delivered += 1
+
+    def unbind(self, sock):
+        with self.lock:
+            if self.sockets.get(sock.address) is sock:
+                del self.sockets[sock.address]
+
+class MemorySocket(object):
+    """Socket stand-in bound to an address on a MemoryNetwork"""
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.inbox = collections.deque()
+        self.received = 0
+
+    def getsockname(self):
+        return self.address
+
+    def recvfrom(self, size):
+        try:
+            data, address = self.inbox.popleft()
+        except IndexError:
+            raise socket.error(errno.EAGAIN, "no data")
+        self.received += 1
+        return data[:size], address
+
+    def sendto(self, data, address):
+        self.network.deliver(data, self.address, address)
+        return len(data)
+
+    def close(self):
+        self.network.unbind(self)
+        self.inbox.clear()
+
+class LoopbackSocket(MemorySocket):
+    """Real socket that also reaches peers on a MemoryNetwork
+
+    Datagrams for addresses bound on the network are handed over in memory
+    without a system call, anything else goes through the real socket.
+    """
+    def __init__(self, network, address, sock):
+        super(LoopbackSocket, self).__init__(network, address)
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recvfrom(self, size):
+        if self.inbox:
+            return super(LoopbackSocket, self).recvfrom(size)
+        return self.sock.recvfrom(size)
+
+    def sendto(self, data, address):
+        if self.network.bound(address):
+            return super(LoopbackSocket, self).sendto(data, address)
+        return self.sock.sendto(data, address)
+
+    def close(self):
+        super(LoopbackSocket, self).close()
+        self.sock.close()
+
+class LoopbackSocketServer(SocketServer):
+    """Handle loopback sockets, reading in-memory datagrams unselected"""
+    def select(self):
+        for sock in self.socks:
+            if sock.inbox:
+                self.read(sock)
+        super(LoopbackSocketServer, self).select()
+
+class VirtualSocketServer(SocketServer):
+    """Handle stand-in sockets that can't be selected on"""
+    def select(self):
+        for sock in self.socks:
+            self.read(sock)
+            while self.queue.write(sock):
+                pass
+
+class SocketSendPool(object):
+    """Encode and send packets from a pool of worker threads
+
+    Work submitted for a tick is run by the workers. Packets they push go
+    through the write queue and are flushed to the socket for that address
+    as far as its send rate allows. Waiting for the previous
+    tick's work before submitting more provides backpressure when sending
+    falls behind the tick rate.
+    """
+    def __init__(self, queue, sock, workers=4):
+        self.queue = queue
+        self.sock = sock
+        self.tasks = Queue.Queue()
+        self.stalls = 0
+        self.threads = []
+        for n in range(workers):
+            thread = threading.Thread(target=self.__work,
+                                      name="send-%d" % n)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Send pool:Task failed")
+            finally:
+                self.tasks.task_done()
+
+    def push(self, data, address, droppable=False, stamp=None):
+        self.queue.push(data, address, droppable, stamp)
+        self.queue.write_address(self.sock, address)
+
+    def submit(self, func, *args):
+        self.tasks.put((func, args))
+
+    def busy(self):
+        return self.tasks.unfinished_tasks > 0
+
+    def wait(self):
+        """Block until all submitted work is done"""
+        if self.busy():
+            self.stalls += 1
+        self.tasks.join()
+
+    def close(self):
+        """Stop the worker threads once submitted work is done"""
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -0,0 +1,104 @@
+"""
+Client sprites
+
+Importing this module pulls in pyglet's graphics stack.
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import pyglet
+import pyglet.image
+import pyglet.resource
+import pyglet.sprite
+
+_images = {}
+_tinted = {}
+
+def load_image(name):
+    """Decode resource image, caching the result
+
+    Only decodes to image data, so this is safe away from the GL thread.
+    """
+    try:
+        return _images[name]
+    except KeyError:
+        resource = pyglet.resource.file(name)
+        try:
+            image = pyglet.image.load(name, file=resource).get_image_data()
+        finally:
+            resource.close()
+        _images[name] = image
+        return image
+
+def alpha_blend(src, dst, alpha):
+    """Alpha blend 0-255 integer color channel
+
+    See http://www.codeguru.com/cpp/cpp/algorithms/general/article.php/c15989/
+    """
+    return ((src * alpha) + (dst * (255 - alpha))) // 255
+
+def tint(image, mask, color):
+    """Replace color in image based on mask, caching the result"""
+    key = (image, mask, color)
+    try:
+        return _tinted[key]
+    except KeyError:
+        pass
+    mask_data = mask.get_image_data().get_data('A', mask.width)
+    image_data = image.get_image_data().get_data('RGBA', image.width * 4)
+    new_data = []
+    for index, alpha in enumerate(mask_data):
+        alpha_ord = ord(alpha)
+        pixel = image_data[index*4:index*4+4]
+        if alpha_ord > 0:
+            pixel = chr(alpha_blend(color[0], ord(pixel[0]), alpha_ord)) + \
+                    chr(alpha_blend(color[1], ord(pixel[1]), alpha_ord)) + \
+                    chr(alpha_blend(color[2], ord(pixel[2]), alpha_ord)) + \
+                    pixel[3]
+        new_data.append(pixel)
+    tinted = pyglet.image.ImageData(image.width, image.height, "RGBA",
+                                    "".join(new_data), image.width * 4)
+    _tinted[key] = tinted
+    return tinted
+
+class ColoredSprite(pyglet.sprite.Sprite):
+    """Sprite that replaces a color based on a color mask image"""
+    def __init__(self, image, mask, color, batch=None, group=None):
+        super(ColoredSprite, self).__init__(
+                tint(image, mask, color),
+                batch=batch,
+                group=group)
+
+class ClientBoxman(ColoredSprite):
+    """Client Boxman entity"""
+    IMAGE = 'boxman.png'
+    MASK = 'boxman-color.png'
+
+    def __init__(self, color, batch=None, group=None):
+        super(ClientBoxman, self).__init__(
+                load_image(self.IMAGE), load_image(self.MASK), color,
+                batch=batch, group=group)
+        self.image.anchor_x = self.width // 2
+        self.image.anchor_y = self.height // 2
+        self.vel_x = 0.0
+        self.vel_y = 0.0
+
+    @classmethod
+    def preload(cls, colors):
+        """Decode and tint images for colors ahead of time"""
+        image = load_image(cls.IMAGE)
+        mask = load_image(cls.MASK)
+        for color in colors:
+            tint(image, mask, color)
+
+    def set_velocity(self, x, y):
+        self.vel_x = x
+        self.vel_y = y
+
+    def update(self, dt):
+        self.set_position(self.x + self.vel_x * dt, self.y + self.vel_y * dt)
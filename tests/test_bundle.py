@@ -0,0 +1,109 @@
+"""
+Dictionary training from recorded bundles
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import random
+import unittest
+
+from entity import EntityStore
+from protocol import bundle, command, reliable, session
+from protocol.local import *
+
+ADDRESS = ("10.0.0.2", 2)
+
+class Recording(object):
+    """Write queue stand-in keeping what is pushed"""
+    def __init__(self):
+        self.datagrams = []
+
+    def push(self, data, address, droppable=False, stamp=None):
+        if stamp is not None:
+            data = stamp(data)
+        self.datagrams.append(data)
+
+class Entity(object):
+    """Boxman stand-in mostly standing still, as players mostly do"""
+    def __init__(self, id, rand):
+        self.id = id
+        self.random = rand
+        self.position = [320.0, 240.0]
+        self.velocity = (0.0, 0.0)
+        self.direction = 0.0
+
+    def step(self):
+        if self.random.random() < 0.1:
+            self.direction = self.random.randrange(0, 360, 15)
+            self.velocity = self.random.choice([(0.0, 0.0), (0.0, 50.0),
+                                                (50.0, 0.0)])
+        self.position[0] += self.velocity[0] / 20.0
+        self.position[1] += self.velocity[1] / 20.0
+
+    def get_position(self):
+        return self.position
+
+    def get_velocity(self):
+        return self.velocity
+
+    def get_direction(self):
+        return self.direction
+
+def record(dictionary, ticks, seed):
+    """Datagrams sent to a peer bundling and compressing with dictionary"""
+    rand = random.Random(seed)
+    recording = Recording()
+    sessions = session.Sessions()
+    sessions.negotiate(ADDRESS, PROTOCOL_VERSION, CAPABILITIES)
+    channels = reliable.ReliableChannels()
+    reliablepack = reliable.ReliablePack(command.HeaderPack(recording),
+                                         channels)
+    bundlepack = bundle.BundlePack(reliablepack, sessions,
+                                   bundle.Compressor(dictionary))
+    updatecmd = command.UpdateCommand(command.CommandPack(bundlepack))
+    entities = EntityStore(8)
+    for id in range(8):
+        entities.add(Entity(id, rand))
+    for tick in range(ticks):
+        for entity in entities:
+            entity.step()
+        entities.sync()
+        updatecmd.send(entities.fields, ADDRESS, tick)
+        bundlepack.flush()
+    return recording.datagrams
+
+def body_sizes(datagrams):
+    return sum(len(bundle.command_payload(data)) for data in datagrams)
+
+class DictionaryTest(unittest.TestCase):
+    def test_recorded_bundles_unwrapped(self):
+        datagrams = record("", 10, seed=1)
+        self.assertTrue(all(bundle.command_payload(data)[:1] ==
+                            bundle.BUNDLE_BYTE for data in datagrams))
+        samples = []
+        for data in datagrams:
+            samples.extend(bundle.bundle_samples(data, bundle.Compressor()))
+        self.assertEqual(len(samples), 10)
+        self.assertTrue(all(sample[bundle.LENGTH.size:][:1] ==
+                            chr(CMD_UPDATE) for sample in samples))
+
+    def test_trained_dictionary_shrinks_payloads(self):
+        compressor = bundle.Compressor()
+        samples = []
+        for data in record("", 200, seed=1):
+            samples.extend(bundle.bundle_samples(data, compressor))
+        dictionary = bundle.build_dictionary(samples)
+        self.assertTrue(dictionary)
+        untrained = body_sizes(record("", 100, seed=2))
+        trained = body_sizes(record(dictionary, 100, seed=2))
+        self.assertTrue(trained < untrained * 0.9,
+                        "%d bytes trained, %d untrained" %
+                        (trained, untrained))
+
+if __name__ == "__main__":
+    unittest.main()
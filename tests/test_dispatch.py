@@ -0,0 +1,114 @@
+"""
+Client state coalescing and malformed packets
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import struct
+import unittest
+
+from protocol import bundle, dispatch, reliable, session
+from protocol.local import *
+import sockwrap
+
+ADDRESS = ("127.0.0.1", 11235)
+SERVER = ("127.0.0.1", 1)
+
+def state(forward, tick, backward=False):
+    return struct.pack("!????I", forward, backward, False, False, tick)
+
+class ClientDispatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = dispatch.ClientDispatch({ADDRESS: None})
+        self.received = []
+        self.dispatcher.push_handlers(on_client=self.on_client)
+
+    def on_client(self, movement, held, tick, address):
+        self.received.append((movement, held, tick))
+
+    def test_coalesced(self):
+        self.dispatcher.dispatch(state(False, 1, backward=True), ADDRESS)
+        self.dispatcher.dispatch(state(True, 3), ADDRESS)
+        self.dispatcher.dispatch(state(True, 2), ADDRESS)
+        self.dispatcher.flush()
+        self.assertEqual(self.received, [((True, False, False, False),
+                                          (True, True, False, False), 3)])
+
+    def test_short_state_dropped(self):
+        self.dispatcher.dispatch(state(True, 1)[:5], ADDRESS)
+        self.dispatcher.flush()
+        self.assertEqual(self.received, [])
+
+class Receiver(object):
+    """Server side receive chain down to client states"""
+    def __init__(self):
+        self.sessions = session.Sessions()
+        self.channels = reliable.ReliableChannels()
+        self.header = dispatch.HeaderDispatch(self.sessions)
+        self.reliable = reliable.ReliableDispatch(self.channels)
+        self.commands = dispatch.CommandDispatch()
+        self.hello = dispatch.HelloDispatch()
+        self.quit = dispatch.QuitDispatch()
+        self.client = dispatch.ClientDispatch({ADDRESS: None})
+        self.bundle = bundle.BundleDispatch(bundle.Compressor(),
+                                            self.sessions)
+        self.header.push_handlers(received_header=self.reliable.dispatch)
+        self.reliable.push_handlers(received_packet=self.commands.dispatch)
+        self.commands.push_handlers(received_hello=self.hello.dispatch,
+                                    received_quit=self.quit.dispatch,
+                                    received_client=self.client.dispatch,
+                                    received_bundle=self.bundle.dispatch)
+        self.bundle.push_handlers(received_packet=self.commands.dispatch)
+        self.sessions.negotiate(ADDRESS, PROTOCOL_VERSION, CAPABILITIES)
+
+class MalformedTest(unittest.TestCase):
+    def test_truncated_packets_dropped(self):
+        receiver = Receiver()
+        header = reliable.pack_header(1, 0, 0)
+        reliable_header = reliable.pack_header(2, 0, 0,
+                                               reliable.FLAG_RELIABLE)
+        packets = ["", "B", "BOX", HEADER_MAGIC, HEADER_MAGIC + "\x00\x01",
+                   HEADER_MAGIC + reliable_header,
+                   HEADER_MAGIC + reliable_header + "\x00",
+                   HEADER_MAGIC + header + chr(CMD_CLIENT) + "\x01",
+                   HEADER_MAGIC + header + chr(CMD_BUNDLE),
+                   HEADER_MAGIC + header + chr(CMD_BUNDLE) + "\x00\x00\x05",
+                   HEADER_MAGIC + header + chr(CMD_BUNDLE) + "\x01\xff",
+                   chr(TOKEN_FLAG)]
+        for data in packets:
+            receiver.header.dispatch(data, ADDRESS)
+
+class ReadLimitTest(unittest.TestCase):
+    def setUp(self):
+        self.network = sockwrap.MemoryNetwork()
+        self.sock = self.network.socket(SERVER)
+        self.received = []
+        self.dispatcher = sockwrap.SocketReadDispatch(self, limit=2)
+        self.server = sockwrap.VirtualSocketServer(
+                self.dispatcher, sockwrap.SocketWriteQueue(), self.sock)
+
+    def dispatch(self, data, address):
+        self.received.append((data, address))
+
+    def test_flood_limited_per_address(self):
+        flood = self.network.socket()
+        quiet = self.network.socket()
+        for n in range(self.server.MAX_READS * 2):
+            flood.sendto("flood", SERVER)
+        quiet.sendto("quiet", SERVER)
+        self.server.update()
+        self.assertEqual(self.received, [("flood", flood.address)] * 2 +
+                                        [("quiet", quiet.address)])
+        self.assertEqual(self.dispatcher.dropped,
+                         self.server.MAX_READS * 2 - 2)
+        flood.sendto("flood", SERVER)
+        self.server.update()
+        self.assertEqual(len(self.received), 4)
+
+if __name__ == "__main__":
+    unittest.main()
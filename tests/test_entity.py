@@ -0,0 +1,87 @@
+"""
+Entity storage and updates packed from its field arrays
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import struct
+import unittest
+
+from entity import EntityStore
+from protocol import command
+from protocol.local import *
+
+ADDRESS = ("10.0.0.2", 2)
+
+class Entity(object):
+    def __init__(self, id):
+        self.id = id
+        self.position = (id * 10.0, id * 20.0)
+        self.velocity = (id + 0.5, -id - 0.5)
+        self.direction = id * 0.25
+
+    def get_position(self):
+        return self.position
+
+    def get_velocity(self):
+        return self.velocity
+
+    def get_direction(self):
+        return self.direction
+
+class Packer(object):
+    def __init__(self):
+        self.packed = []
+
+    def pack(self, cmd, data, sendto):
+        self.packed.append((cmd, data))
+
+def expected(entities, tick):
+    data = [struct.pack("!II", tick, len(entities))]
+    for entity in entities:
+        data.append(command.ENTITY_UPDATE.pack(entity.id,
+                entity.position[0], entity.position[1], entity.direction,
+                entity.velocity[0], entity.velocity[1]))
+    return "".join(data)
+
+class EntityStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = EntityStore(16)
+        for id in (3, 5, 7, 9):
+            self.store.add(Entity(id), ("10.0.0.%d" % id, id))
+
+    def test_fields_follow_swap_remove(self):
+        self.store.remove(5)
+        self.store.remove(9)
+        fields = self.store.fields
+        self.assertEqual(list(fields.ids), [entity.id
+                                            for entity in self.store])
+        self.assertEqual(list(fields.y), [entity.position[1]
+                                          for entity in self.store])
+        self.assertEqual(self.store.owner(7), ("10.0.0.7", 7))
+
+    def test_sync_copies_moved_state(self):
+        entity = self.store.get(7)
+        entity.position = (1.0, 2.0)
+        self.store.sync()
+        self.assertEqual(self.store.fields.x[self.store.slots[7]], 1.0)
+
+    def test_update_packed_from_fields(self):
+        packer = Packer()
+        updatecmd = command.UpdateCommand(packer)
+        updatecmd.send(self.store.fields, ADDRESS, 42)
+        self.store.remove(3)
+        updatecmd.send(self.store.fields.copy(), ADDRESS, 43)
+        self.assertEqual(packer.packed, [
+                (CMD_UPDATE, expected([Entity(id) for id in (3, 5, 7, 9)],
+                                      42)),
+                (CMD_UPDATE, expected([Entity(id) for id in (9, 5, 7)],
+                                      43))])
+
+if __name__ == "__main__":
+    unittest.main()
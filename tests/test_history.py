@@ -0,0 +1,45 @@
+"""
+Entity state history
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import unittest
+
+from history import StateHistory
+
+class Entity(object):
+    def __init__(self, id, position):
+        self.id = id
+        self.position = position
+
+    def get_position(self):
+        return self.position
+
+class StateHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.history = StateHistory(4, 8)
+        # Wrap the ring so the oldest tick isn't in the first slot
+        for tick in range(6):
+            self.history.record(tick, tick * 0.05,
+                                [Entity(1, (tick * 10.0, 100.0))])
+
+    def test_interpolates_between_ticks(self):
+        x, y = self.history.position_at(1, 0.175)
+        self.assertAlmostEqual(x, 35.0)
+        self.assertAlmostEqual(y, 100.0)
+
+    def test_clamps_outside_history(self):
+        self.assertEqual(self.history.position_at(1, 0.0), (20.0, 100.0))
+        self.assertEqual(self.history.position_at(1, 1.0), (50.0, 100.0))
+
+    def test_unknown_entity(self):
+        self.assertEqual(self.history.position_at(2, 0.175), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+Import cost of the network side
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHECK = """
+import sys
+import client, server, soak, sockwrap
+from protocol import bundle, command, dispatch, reliable, session
+graphics = [name for name in ("pyglet.gl", "pyglet.window", "pyglet.sprite",
+                              "pyglet.image", "sprite")
+            if sys.modules.get(name) is not None]
+sys.stdout.write(" ".join(graphics))
+"""
+
+class ImportTest(unittest.TestCase):
+    def test_network_side_leaves_out_graphics(self):
+        # A fresh interpreter, since other tests may have imported anything
+        process = subprocess.Popen([sys.executable, "-c", CHECK], cwd=ROOT,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(output.decode("ascii").strip(), "")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Replaying recordings on recorded time
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from protocol import command, reliable
+import record
+from server import create_server
+
+SERVER = ("127.0.0.1", 11235)
+
+class Inbound(object):
+    """Write queue stand-in recording datagrams as received at now"""
+    def __init__(self, recorder, address):
+        self.recorder = recorder
+        self.address = address
+        self.now = 0.0
+
+    def push(self, data, address, droppable=False, stamp=None):
+        if stamp is not None:
+            data = stamp(data)
+        self.recorder.record(record.REC_IN, data, self.address, self.now)
+
+def hello(recorder, address, now):
+    inbound = Inbound(recorder, address)
+    inbound.now = now
+    reliablepack = reliable.ReliablePack(command.HeaderPack(inbound),
+                                         reliable.ReliableChannels())
+    command.HelloCommand(command.CommandPack(reliablepack)).send(SERVER)
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "replay.rec")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_timeouts_follow_recorded_time(self):
+        # The first client goes quiet for longer than the timeout in recorded
+        # time, however quickly the replay runs
+        recorder = record.Recorder(self.path)
+        hello(recorder, ("10.0.0.2", 2), 1000.0)
+        hello(recorder, ("10.0.0.3", 3), 1030.0)
+        recorder.close()
+        reader = record.RecordReader(self.path)
+        replayer = record.Replayer(reader)
+        server = create_server("0.0.0.0", headless=True,
+                               clock=replayer.clock)
+        try:
+            replayer.replay(server.sock_server.dispatcher.dispatcher, server)
+        finally:
+            server.close()
+            reader.close()
+        self.assertEqual(server.evictions, 1)
+        self.assertEqual(len(server.entities.addresses), 1)
+
+if __name__ == "__main__":
+    unittest.main()
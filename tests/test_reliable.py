@@ -0,0 +1,287 @@
+"""
+Reliability layer over a lossy link
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import heapq
+import random
+import unittest
+
+from protocol import command, dispatch, reliable
+from protocol.local import *
+import sockwrap
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class Peer(object):
+    """One end of a LossyLink running the reliability layer"""
+    def __init__(self, link, address):
+        self.link = link
+        self.address = address
+        self.channels = reliable.ReliableChannels(clock=link.clock)
+        self.reliablepack = reliable.ReliablePack(self, self.channels)
+        self.dispatcher = reliable.ReliableDispatch(self.channels)
+        self.dispatcher.push_handlers(received_packet=self.received_packet)
+        self.received = []
+        self.droppable = []
+
+    def pack(self, data, sendto, droppable=False, stamp=None):
+        self.droppable.append(droppable)
+        if stamp is not None:
+            data = stamp(data)
+        self.link.send(data, self.address, sendto)
+
+    def received_packet(self, data, address):
+        self.received.append(data)
+
+    def update(self):
+        self.reliablepack.update()
+
+class QueuedPeer(Peer):
+    """Peer sending through a paced write queue like the server does"""
+    def __init__(self, link, address, rate=60.0):
+        super(QueuedPeer, self).__init__(link, address)
+        self.queue = sockwrap.SocketWriteQueue(rate=rate, clock=link.clock)
+        self.channels.congestion = self.queue.congestion
+
+    def pack(self, data, sendto, droppable=False, stamp=None):
+        self.droppable.append(droppable)
+        self.queue.push(data, sendto, droppable, stamp)
+
+    def sendto(self, data, address):
+        self.link.send(data, self.address, address)
+
+    def update(self):
+        self.reliablepack.update()
+        while self.queue.write(self):
+            pass
+
+class LossyLink(object):
+    """Datagram link with seeded loss, duplication, reordering and outages"""
+    def __init__(self, seed, loss=0.3, duplicate=0.1, max_delay=0.1):
+        self.random = random.Random(seed)
+        self.loss = loss
+        self.duplicate = duplicate
+        self.max_delay = max_delay
+        self.clock = Clock()
+        self.peers = {}
+        self.in_flight = []
+        self.sequence = 0
+        self.down = False
+
+    def attach(self, address, peer=Peer):
+        peer = self.peers[address] = peer(self, address)
+        return peer
+
+    def send(self, data, source, address):
+        if self.down or self.random.random() < self.loss:
+            return
+        copies = 1
+        if self.random.random() < self.duplicate:
+            copies = 2
+        for n in range(copies):
+            arrival = self.clock() + self.random.uniform(0.0, self.max_delay)
+            heapq.heappush(self.in_flight,
+                           (arrival, self.sequence, data, source, address))
+            self.sequence += 1
+
+    def run(self, seconds, step=0.01):
+        for n in range(int(round(seconds / step))):
+            self.clock.now += step
+            while self.in_flight and self.in_flight[0][0] <= self.clock():
+                arrival, sequence, data, source, address = \
+                        heapq.heappop(self.in_flight)
+                if address in self.peers:
+                    self.peers[address].dispatcher.dispatch(data, source)
+            for peer in self.peers.values():
+                peer.update()
+
+class Entity(object):
+    color = (0, 0, 255)
+
+    def __init__(self, id):
+        self.id = id
+
+class EntityTracker(object):
+    def __init__(self):
+        self.entities = set()
+        self.events = []
+
+    def on_spawn_entity(self, type, id, color, address):
+        self.entities.add(id)
+        self.events.append(("spawn", id))
+
+    def on_destroy_entity(self, id, address):
+        self.entities.discard(id)
+        self.events.append(("destroy", id))
+
+A = ("10.0.0.1", 1)
+B = ("10.0.0.2", 2)
+
+class ReliableTest(unittest.TestCase):
+    def setUp(self):
+        self.link = LossyLink(seed=1)
+        self.a = self.link.attach(A)
+        self.b = self.link.attach(B)
+
+    def test_reliable_in_order_once(self):
+        messages = ["message %d" % n for n in range(200)]
+        for message in messages:
+            self.a.reliablepack.pack(message, B, reliable=True)
+            self.link.run(0.02)
+        self.link.run(10.0)
+        self.assertEqual(self.b.received, messages)
+        self.assertFalse(self.a.channels.get(B).pending)
+        self.assertTrue(self.a.channels.resent > 0)
+
+    def test_sequence_wraps(self):
+        # Sequence numbers share their field with the reliable flag
+        self.a.channels.get(B).seq = reliable.SEQ_MOD - 20
+        messages = ["message %d" % n for n in range(100)]
+        for message in messages:
+            self.a.reliablepack.pack(message, B, reliable=True)
+            self.link.run(0.02)
+        self.link.run(10.0)
+        self.assertEqual(self.b.received, messages)
+        self.assertFalse(self.a.channels.get(B).pending)
+
+    def test_unreliable_not_duplicated_or_stale(self):
+        messages = ["%04d" % n for n in range(200)]
+        for message in messages:
+            self.a.reliablepack.pack(message, B)
+            self.link.run(0.02)
+        self.link.run(1.0)
+        self.assertTrue(self.b.received)
+        self.assertEqual(self.b.received, sorted(set(self.b.received)))
+        self.assertTrue(set(self.b.received) <= set(messages))
+
+    def test_spawn_destroy_survive_outage(self):
+        cmdpack = command.CommandPack(self.a.reliablepack)
+        spawncmd = command.SpawnCommand(cmdpack)
+        destroycmd = command.DestroyCommand(cmdpack)
+        cmd_dispatcher = dispatch.CommandDispatch()
+        spawn_dispatcher = dispatch.SpawnDispatch()
+        destroy_dispatcher = dispatch.DestroyDispatch()
+        tracker = EntityTracker()
+        cmd_dispatcher.push_handlers(
+                received_spawn=spawn_dispatcher.dispatch,
+                received_destroy=destroy_dispatcher.dispatch)
+        spawn_dispatcher.push_handlers(tracker)
+        destroy_dispatcher.push_handlers(tracker)
+        self.b.dispatcher.push_handlers(
+                received_packet=cmd_dispatcher.dispatch)
+        for id in (1, 2, 3):
+            spawncmd.send(ENT_BOXMAN, Entity(id), B)
+        self.link.run(0.05)
+        # Long enough to use up every resend under the old give up policy
+        self.link.down = True
+        spawncmd.send(ENT_BOXMAN, Entity(4), B)
+        destroycmd.send(2, B)
+        spawncmd.send(ENT_BOXMAN, Entity(5), B)
+        self.link.run(2.5)
+        destroycmd.send(5, B)
+        self.link.down = False
+        self.link.run(10.0)
+        self.assertEqual(tracker.entities, set([1, 3, 4]))
+        self.assertEqual(tracker.events, [
+                ("spawn", 1), ("spawn", 2), ("spawn", 3), ("spawn", 4),
+                ("destroy", 2), ("spawn", 5), ("destroy", 5)])
+        self.assertEqual(self.a.channels.abandoned, 0)
+
+    def test_only_droppable_data_superseded(self):
+        self.a.reliablepack.pack("input", B)
+        self.a.reliablepack.pack("snapshot", B, droppable=True)
+        self.a.reliablepack.pack("spawn", B, reliable=True, droppable=True)
+        self.assertEqual(self.a.droppable, [False, True, False])
+        # Retransmits and bare acks must not replace queued input either
+        self.link.loss = 0.0
+        self.link.down = True
+        self.b.channels.get(A).ack_pending = True
+        self.link.run(1.0)
+        self.assertTrue(len(self.a.droppable) > 3)
+        self.assertFalse(any(self.a.droppable[3:]))
+        self.assertTrue(self.b.droppable)
+        self.assertFalse(any(self.b.droppable))
+
+    def test_forgotten_peer_abandoned(self):
+        self.a.reliablepack.pack("hello", B, reliable=True)
+        del self.link.peers[B]
+        self.a.channels.forget(B)
+        self.link.run(60.0)
+        self.assertTrue(self.a.channels.abandoned > 0)
+        self.assertFalse(B in self.a.channels)
+
+class CongestionTest(unittest.TestCase):
+    def setUp(self):
+        self.link = LossyLink(seed=2, loss=0.0, duplicate=0.0,
+                              max_delay=0.02)
+        self.server = self.link.attach(A, QueuedPeer)
+        self.client = self.link.attach(B)
+
+    def snapshots(self, seconds, tick=0.05):
+        for n in range(int(round(seconds / tick))):
+            self.server.reliablepack.pack("snapshot", B, droppable=True)
+            self.link.run(tick)
+
+    def test_rate_recovers_after_blackout(self):
+        self.snapshots(5.0)
+        rate = self.server.queue.congestion(B).rate
+        self.link.down = True
+        self.snapshots(1.0)
+        self.link.down = False
+        self.snapshots(2.0)
+        congestion = self.server.queue.congestion(B)
+        # Every snapshot sent in the dark is lost but the rate halves once
+        self.assertTrue(self.server.channels.lost >= 20)
+        self.assertTrue(congestion.rate >= rate * 0.5)
+        self.snapshots(10.0)
+        self.assertTrue(congestion.rate >= rate)
+
+    def backed_up(self):
+        """Send reliable messages through a queue kept full of snapshots"""
+        self.server.queue.initial_rate = 5.0
+        messages = ["message %d" % n for n in range(40)]
+        for message in messages:
+            self.server.reliablepack.pack(message, B, reliable=True)
+            self.snapshots(0.025, tick=0.025)
+        self.snapshots(30.0, tick=0.025)
+        self.assertTrue(self.server.queue.superseded > 0)
+        received = [data for data in self.client.received
+                    if data != "snapshot"]
+        self.assertEqual(received, messages)
+
+    def test_backed_up_queue_nothing_lost(self):
+        self.backed_up()
+        # Superseded snapshots never reached the wire so weren't lost
+        self.assertEqual(self.server.channels.lost, 0)
+        self.assertEqual(self.server.queue.congestion(B).losses, 0)
+
+    def test_backed_up_queue_lossy(self):
+        self.link.loss = 0.3
+        self.link.duplicate = 0.1
+        self.backed_up()
+        self.assertTrue(self.server.channels.lost > 0)
+
+    def test_round_trip_excludes_queueing(self):
+        self.server.queue.initial_rate = 5.0
+        for n in range(5):
+            self.server.reliablepack.pack("message %d" % n, B,
+                                          reliable=True)
+        self.link.run(3.0)
+        self.assertEqual(len(self.client.received), 5)
+        # Queued for up to a second, but only on the wire for the delay
+        self.assertTrue(self.server.channels.get(B).rtt < 0.1)
+
+if __name__ == "__main__":
+    unittest.main()
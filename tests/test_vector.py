@@ -0,0 +1,30 @@
+"""
+Quantized heading table
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import unittest
+
+import vector
+
+class HeadingTableTest(unittest.TestCase):
+    def test_error_within_bound(self):
+        for shift in range(13):
+            headings = vector.HeadingTable(1 << shift)
+            self.assertTrue(headings.error() <= headings.bound(),
+                            "%d steps:error %r over bound %r" %
+                            (headings.steps, headings.error(),
+                             headings.bound()))
+
+    def test_rejects_other_steps(self):
+        for steps in (0, -4, 3, 100):
+            self.assertRaises(ValueError, vector.HeadingTable, steps)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,6 +9,7 @@ Vector maths
 # To Public License, Version 2, as published by Sam Hocevar. See
 # http://sam.zoy.org/wtfpl/COPYING for more details.
 
+import array
 import math
 
 (VEC_X, VEC_Y, VEC_Z) = range(3)
@@ -79,3 +80,57 @@ class Vec2(object):
 
     def __len__(self):
         return 2
+
+class HeadingTable(object):
+    """Unit vectors for headings quantized to a power of two steps
+
+    Cosines and sines are stored as 16.16 fixed point integers, so lookups
+    give the same doubles on every platform regardless of its maths
+    library. Headings wrap by masking. Compared with Vec2.from_angle a
+    vector differs by at most error(), which is within bound(): the chord
+    across half a step plus rounding of both components (about 0.0008 for
+    4096 steps).
+    """
+    ONE = 1 << 16
+
+    def __init__(self, steps=4096):
+        if steps < 1 or steps & (steps - 1):
+            raise ValueError("steps must be a power of two")
+        self.steps = steps
+        self.mask = steps - 1
+        self.step_angle = 2.0 * math.pi / steps
+        self.cos = array.array('i', [int(round(math.cos(n * self.step_angle)
+                                               * self.ONE))
+                                     for n in range(steps)])
+        self.sin = array.array('i', [int(round(math.sin(n * self.step_angle)
+                                               * self.ONE))
+                                     for n in range(steps)])
+
+    def heading(self, angle):
+        """Nearest heading to angle in radians"""
+        return int(round(angle / self.step_angle)) & self.mask
+
+    def angle(self, heading):
+        return (heading & self.mask) * self.step_angle
+
+    def vector(self, heading, magnitude=1.0):
+        heading &= self.mask
+        scale = magnitude / self.ONE
+        return Vec2(self.cos[heading] * scale, self.sin[heading] * scale)
+
+    def bound(self):
+        """Most error() can be, 2 sin(pi / 2 steps) + sqrt(2) 2 ** -17"""
+        return 2.0 * math.sin(math.pi / (2 * self.steps)) + \
+               math.sqrt(2.0) * 0.5 / self.ONE
+
+    def error(self):
+        """Largest difference from Vec2.from_angle over all angles"""
+        worst = 0.0
+        for n in range(self.steps):
+            # Half way between steps is furthest from a table entry
+            for angle in (n * self.step_angle,
+                          (n + 0.5) * self.step_angle):
+                exact = Vec2.from_angle(angle)
+                diff = exact - self.vector(self.heading(angle))
+                worst = max(worst, diff.magnitude())
+        return worst
@@ -0,0 +1,52 @@
+"""
+Game window
+"""
+# Copyright (C) 2008 James Fargher
+
+# This program is free software. It comes without any warranty, to
+# the extent permitted by applicable law. You can redistribute it
+# and/or modify it under the terms of the Do What The Fuck You Want
+# To Public License, Version 2, as published by Sam Hocevar. See
+# http://sam.zoy.org/wtfpl/COPYING for more details.
+
+import pyglet
+
+class MainWindow(pyglet.window.Window):
+    def __init__(self, client):
+        super(MainWindow, self).__init__()
+        self.clock = pyglet.clock.ClockDisplay()
+        self.client = client
+
+    def on_key_press(self, symbol, modifiers):
+        if symbol == pyglet.window.key.UP:
+            self.client.start_move(forward=True)
+        elif symbol == pyglet.window.key.DOWN:
+            self.client.start_move(backward=True)
+        elif symbol == pyglet.window.key.LEFT:
+            self.client.start_move(rot_ccw=True)
+        elif symbol == pyglet.window.key.RIGHT:
+            self.client.start_move(rot_cw=True)
+        elif symbol == pyglet.window.key.ESCAPE:
+            self.client.send_quit()
+
+    def on_key_release(self, symbol, modifiers):
+        if symbol == pyglet.window.key.UP:
+            self.client.stop_move(forward=True)
+        elif symbol == pyglet.window.key.DOWN:
+            self.client.stop_move(backward=True)
+        elif symbol == pyglet.window.key.LEFT:
+            self.client.stop_move(rot_ccw=True)
+        elif symbol == pyglet.window.key.RIGHT:
+            self.client.stop_move(rot_cw=True)
+
+    def on_client_quit(self):
+        pyglet.app.event_loop.exit()
+
+    def on_close(self):
+        self.client.send_quit()
+        return pyglet.event.EVENT_HANDLED
+
+    def on_draw(self):
+        self.clear()
+        self.client.draw()
+        self.clock.draw()